@@ -0,0 +1,167 @@
+"""
+Copyright (c) 2021, Electric Power Research Institute
+ All rights reserved.
+ Redistribution and use in source and binary forms, with or without modification,
+ are permitted provided that the following conditions are met:
+     * Redistributions of source code must retain the above copyright notice,
+       this list of conditions and the following disclaimer.
+     * Redistributions in binary form must reproduce the above copyright notice,
+       this list of conditions and the following disclaimer in the documentation
+       and/or other materials provided with the distribution.
+     * Neither the name of DER-VET nor the names of its contributors
+       may be used to endorse or promote products derived from this software
+       without specific prior written permission.
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+ "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+ LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+ A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+ CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+ EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+ PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+ PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+ LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+ NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+#exactness checks for the fast paths - each of them promises results identical to a separate run_smooth_controller call, bit for bit
+#   compiled kernel vs the plain python kernel, batched candidates (compiled, vectorized and per-candidate python paths) vs single runs,
+#   per-candidate forecast rows vs single runs with that forecast, per-day totals vs whole-record totals, and streaming vs batch
+#the csv loader and fleet mode are checked on files that cross a daylight saving change and on a file with only a power column
+#
+#   python benchmarks/check_equivalence.py        exits 1 and lists the mismatches if any check fails
+
+import os
+import sys
+import itertools
+import tempfile
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import ramp_rate_control
+import ramp_rate_forecast
+import ramp_rate_data
+import ramp_rate_fleet
+from synthetic_pv import synthetic_pv
+from run_benchmarks import SETTINGS
+
+
+#just enough parameter sets for the vectorized kernel to be used without numba
+def _candidates():
+    n = ramp_rate_control.BATCH_VECTORIZE_MIN
+    rng = np.random.RandomState(0)
+    return rng.uniform(0, 2, n), rng.uniform(0, 2, n), rng.uniform(0, 8, n), rng.uniform(0.3, 0.7, n)
+
+#settings for every combination of forecast and curtailment options at each ramp interval
+def _setting_cases(ramp_intervals):
+    for ramp_interval, short_forecast, curtail in itertools.product(ramp_intervals, [0, 1], ['none', 'curtail_as_control', 'curtail_if_violation']):
+        settings = dict(SETTINGS, ramp_interval=ramp_interval, short_forecast=short_forecast)
+        if curtail != 'none':
+            settings[curtail] = 1
+        yield '%d min, short_forecast=%d, %s' % (ramp_interval, short_forecast, curtail), settings
+
+#run function once per kernel - the compiled one if numba is installed and the python one - restoring USE_JIT afterwards
+def _each_kernel(function):
+    use_jit = ramp_rate_control.USE_JIT
+    results = []
+    try:
+        for jit in ([True, False] if ramp_rate_control.numba is not None else [False]):
+            ramp_rate_control.USE_JIT = jit
+            results.append((jit, function()))
+    finally:
+        ramp_rate_control.USE_JIT = use_jit
+    return results
+
+def _mismatch(failures, name, a, b):
+    if not np.array_equal(np.asarray(a), np.asarray(b), equal_nan=True):
+        failures.append(name)
+
+#run every check on days of synthetic data - returns the names of the checks that failed
+def check_equivalence(days=3, ramp_intervals=(1, 5, 10, 15)):
+    pv = synthetic_pv(days=days, seed=1)
+    kp, ki, kf, soc_rest = _candidates()
+    failures = []
+    for case, settings in _setting_cases(ramp_intervals):
+        #single runs are the reference
+        single = [ramp_rate_control.run_smooth_controller(pv, settings.copy(), 0, *p) for p in zip(kp, ki, kf, soc_rest)]
+        single_violations = [s[0] for s in single]
+        single_energy = [s[1] for s in single]
+        
+        for jit, (violations, energy) in _each_kernel(lambda: ramp_rate_control.run_smooth_controller_batch(pv, settings.copy(), kp, ki, kf, soc_rest)):
+            _mismatch(failures, 'batch violations (%s, jit=%s)' % (case, jit), violations, single_violations)
+            _mismatch(failures, 'batch energy (%s, jit=%s)' % (case, jit), energy, single_energy)
+        _mismatch(failures, 'small batch energy (%s)' % case,
+                  ramp_rate_control.run_smooth_controller_batch(pv, settings.copy(), kp[:4], ki[:4], kf[:4], soc_rest[:4])[1], single_energy[:4])
+        
+        #compiled and python kernels give identical output arrays
+        arrays = _each_kernel(lambda: ramp_rate_control.run_smooth_controller_result(pv, settings.copy(), kp[0], ki[0], kf[0], soc_rest[0]).to_frame())
+        if len(arrays) == 2 and not arrays[0][1].equals(arrays[1][1]):
+            failures.append('compiled vs python kernel (%s)' % case)
+        
+        #per-day totals add up to the whole record
+        days_index, daily_violations, daily_energy = ramp_rate_control.run_smooth_controller_daily(pv, settings.copy(), kp, ki, kf, soc_rest)
+        _mismatch(failures, 'daily violations (%s)' % case, daily_violations.sum(axis=1), single_violations)
+        
+        #a row per candidate in the forecast matches a single run given that forecast
+        if settings['short_forecast']:
+            _, ensemble = ramp_rate_forecast.forecast_ensemble(pv, settings, members=len(kp), seed=2)
+            for jit, (violations, energy) in _each_kernel(lambda: ramp_rate_control.run_smooth_controller_batch(pv, settings.copy(), kp[0], ki[0], kf[0], soc_rest[0], forecast=ensemble)):
+                member = [ramp_rate_control.run_smooth_controller_batch(pv, settings.copy(), kp[0], ki[0], kf[0], soc_rest[0], forecast=row) for row in ensemble]
+                _mismatch(failures, 'ensemble violations (%s, jit=%s)' % (case, jit), violations, [m[0][0] for m in member])
+                _mismatch(failures, 'ensemble energy (%s, jit=%s)' % (case, jit), energy, [m[1][0] for m in member])
+        
+        #streaming emits the batch outputs
+        batch = ramp_rate_control.run_smooth_controller_result(pv, settings.copy(), kp[0], ki[0], kf[0], soc_rest[0]).to_frame()
+        controller = ramp_rate_control.SmoothController(settings, kp[0], ki[0], kf[0], soc_rest[0])
+        half = len(pv)//2
+        streamed = pd.concat([controller.update_chunk(pv.iloc[:half]), controller.update_chunk(pv.iloc[half:]), ramp_rate_control.SmoothController._frame(controller.flush())])
+        for column, streamed_column in [('out_power', 'out_power'), ('battery_soc', 'battery_soc'), ('violation', 'violation'), ('curtail_power', 'curtail_power')]:
+            _mismatch(failures, 'streaming %s (%s)' % (column, case), streamed[streamed_column].values, batch[column].values)
+    return failures
+
+#load csv files written from a synthetic series over the spring daylight saving change - returns the names of the checks that failed
+def check_loader():
+    failures = []
+    index = pd.date_range('2019-03-08', '2019-03-13', freq='min', tz='US/Eastern', inclusive='left')
+    pv = pd.Series(synthetic_pv(days=5, seed=3).values[:len(index)], index=index) #the spring day is an hour short
+    offsets = index.strftime('%Y-%m-%d %H:%M:%S%z').str.replace(r'(\d\d)(\d\d)$', r'\1:\2', regex=True) #ISO offsets, -05:00 then -04:00
+    with tempfile.TemporaryDirectory() as directory:
+        sites = os.path.join(directory, 'sites')
+        os.makedirs(sites)
+        local_path = os.path.join(sites, 'local.csv')
+        pd.DataFrame({'Time': offsets, 'Power': pv.values}).to_csv(local_path, index=False)
+        pd.DataFrame({'Time': index.tz_localize(None) + pd.Timedelta(days=30), 'Power': pv.values}).to_csv(os.path.join(sites, 'naive.csv'), index=False)
+        power_path = os.path.join(directory, 'power_only.csv')
+        pd.DataFrame({'Power': pv.values}).to_csv(power_path, index=False)
+        
+        try:
+            loaded = ramp_rate_data.load_pv_data(local_path, tz='US/Eastern', chunksize=2000)
+            if not loaded.series().index.equals(index):
+                failures.append('loader index across daylight saving')
+            reference = ramp_rate_control.run_smooth_controller(loaded.series(), SETTINGS.copy(), 0)
+            if ramp_rate_data.run_chunked(loaded, SETTINGS, chunk_size=2000)[0] != reference[0]:
+                failures.append('chunked violations across daylight saving')
+            if not ramp_rate_data.load_pv_data(local_path, chunksize=2000).series().index.equals(index.tz_convert('UTC')):
+                failures.append('loader index across daylight saving without tz')
+        except Exception as e:
+            failures.append('loader across daylight saving: %s: %s' % (type(e).__name__, e))
+        try:
+            if not ramp_rate_data.load_pv_data(power_path, start='2019-03-08', freq='min', tz='US/Eastern', chunksize=2000).series().index.equals(index):
+                failures.append('loader index from start and freq')
+        except Exception as e:
+            failures.append('loader with only a power column: %s: %s' % (type(e).__name__, e))
+        
+        results = ramp_rate_fleet.run_fleet(sites, SETTINGS, os.path.join(directory, 'fleet.csv'), optimize=False, tz='US/Eastern')
+        for site, error in zip(results['site'], results['error']):
+            if isinstance(error, str):
+                failures.append('fleet site %s: %s' % (site, error))
+    return failures
+
+
+if __name__ == '__main__':
+    failures = check_equivalence() + check_loader()
+    for failure in failures:
+        print('MISMATCH %s' % failure)
+    print('%d mismatches' % len(failures))
+    sys.exit(1 if failures else 0)
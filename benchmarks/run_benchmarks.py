@@ -0,0 +1,175 @@
+"""
+Copyright (c) 2021, Electric Power Research Institute
+ All rights reserved.
+ Redistribution and use in source and binary forms, with or without modification,
+ are permitted provided that the following conditions are met:
+     * Redistributions of source code must retain the above copyright notice,
+       this list of conditions and the following disclaimer.
+     * Redistributions in binary form must reproduce the above copyright notice,
+       this list of conditions and the following disclaimer in the documentation
+       and/or other materials provided with the distribution.
+     * Neither the name of DER-VET nor the names of its contributors
+       may be used to endorse or promote products derived from this software
+       without specific prior written permission.
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+ "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+ LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+ A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+ CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+ EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+ PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+ PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+ LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+ NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+#benchmark suite - times the controller and the optimization on synthetic PV profiles, writes the results to a json file
+#and fails (exit code 1) when the throughput of any case drops more than --threshold below a stored baseline
+#the exactness checks of check_equivalence.py run first and fail the run as well
+#
+#   python benchmarks/run_benchmarks.py                        run and compare against benchmarks/baseline.json if it exists
+#   python benchmarks/run_benchmarks.py --save-baseline        run and store the results as the baseline for this machine
+#   python benchmarks/run_benchmarks.py --quick                shorter records, for a fast check
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import ramp_rate_control
+import ramp_rate_optimization
+from synthetic_pv import synthetic_pv
+
+
+SETTINGS = {
+    "max_ramp": 0.1,
+    "ramp_interval": 10,
+    "AC_upper_bound_on": 1,
+    "AC_lower_bound_on": 1,
+    "AC_upper_bound": 1.05,
+    "AC_lower_bound": -0.01,
+    'short_forecast': 0,
+    "forecast_shift_periods": 3,
+    'battery_energy': 0.05, #small enough that the synthetic cloud ramps still cause violations
+    'battery_power': 1,
+    'round_trip_efficiency': 0.9,
+    'curtail_as_control': 0,
+    'curtail_if_violation': 0,
+}
+
+#controller variants timed at every data length and ramp interval
+VARIANTS = {
+    'base': {},
+    'forecast': {'short_forecast': 1},
+    'curtail_as_control': {'curtail_as_control': 1},
+    'curtail_if_violation': {'curtail_if_violation': 1},
+}
+
+
+#median wall time of repeats calls of function, each made with a cold preprocessing cache
+def _time(function, repeats):
+    times = []
+    for _ in range(repeats):
+        ramp_rate_control.preprocess_cache.clear()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+def _record(results, name, seconds, work, unit, **params):
+    results.append({'name': name, 'params': params, 'seconds': seconds, 'throughput': work/seconds, 'unit': unit})
+    print('%-70s %10.4f s %14.1f %s' % (name, seconds, work/seconds, unit))
+
+def run_benchmarks(day_lengths, ramp_intervals, repeats, sweep_lengths):
+    results = []
+    data = {days: synthetic_pv(days=days, seed=days) for days in sorted(set(day_lengths) | set(sweep_lengths))}
+    #compile the kernel (if numba is installed) before anything is timed
+    ramp_rate_control.run_smooth_controller(data[min(data)].iloc[:1440], SETTINGS.copy(), 0)
+    
+    for days in day_lengths:
+        for ramp_interval in ramp_intervals:
+            intervals = days*1440/ramp_interval
+            for variant, overrides in VARIANTS.items():
+                settings = dict(SETTINGS, ramp_interval=ramp_interval, **overrides)
+                seconds = _time(lambda: ramp_rate_control.run_smooth_controller(data[days], settings.copy(), 0), repeats)
+                _record(results, 'run_smooth_controller/%s/days=%d/ramp_interval=%d' % (variant, days, ramp_interval), seconds, intervals, 'intervals/s',
+                        variant=variant, days=days, ramp_interval=ramp_interval)
+            
+            #one level of the grid search (8 grid points, each run on the zero filled training set and the zero filled testing set, both full length)
+            settings = dict(SETTINGS, ramp_interval=ramp_interval)
+            seconds = _time(lambda: ramp_rate_optimization.optimize_params(data[days], settings.copy(), seed=0, max_evaluations=8), repeats)
+            _record(results, 'optimize_params_level/days=%d/ramp_interval=%d' % (days, ramp_interval), seconds, 16*intervals, 'intervals/s',
+                    days=days, ramp_interval=ramp_interval)
+    
+    for sweep_days in sweep_lengths:
+        for ramp_interval in ramp_intervals:
+            sizes = [0.05, 0.02]
+            settings = dict(SETTINGS, ramp_interval=ramp_interval)
+            seconds = _time(lambda: ramp_rate_optimization.size_sweep(data[sweep_days], settings.copy(), sizes, seed=0), 1)
+            _record(results, 'size_sweep/days=%d/ramp_interval=%d' % (sweep_days, ramp_interval), seconds, len(sizes), 'sizes/s',
+                    days=sweep_days, ramp_interval=ramp_interval)
+    return results
+
+#cases whose throughput fell more than threshold (a fraction) below the baseline - list of (name, baseline, current)
+def compare(results, baseline, threshold):
+    reference = {r['name']: r['throughput'] for r in baseline['results']}
+    return [(r['name'], reference[r['name']], r['throughput']) for r in results
+            if r['name'] in reference and r['throughput'] < reference[r['name']]*(1 - threshold)]
+
+def main(argv=None):
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description='Benchmark the ramp rate controller and optimization on synthetic PV data')
+    parser.add_argument('--output', default=os.path.join(here, 'results.json'), help='json file the results are written to')
+    parser.add_argument('--baseline', default=os.path.join(here, 'baseline.json'), help='stored baseline to compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline instead of comparing')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed throughput drop as a fraction of the baseline (default 0.2)')
+    parser.add_argument('--repeats', type=int, default=3, help='timed repeats per case, the median is reported')
+    parser.add_argument('--days', default='30,90,365', help='comma separated data lengths in days')
+    parser.add_argument('--ramp-intervals', default='1,5,10', help='comma separated ramp intervals in minutes')
+    parser.add_argument('--sweep-days', default='30,90', help='comma separated data lengths in days of the size_sweep cases')
+    parser.add_argument('--quick', action='store_true', help='7 and 30 day records, one repeat')
+    parser.add_argument('--skip-equivalence', action='store_true', help='do not run the exactness checks first')
+    args = parser.parse_args(argv)
+    
+    if not args.skip_equivalence:
+        from check_equivalence import check_equivalence, check_loader
+        failures = check_equivalence() + check_loader()
+        for failure in failures:
+            print('MISMATCH %s' % failure)
+        if failures:
+            return 1
+    
+    day_lengths = [int(d) for d in args.days.split(',')]
+    repeats = args.repeats
+    sweep_lengths = [int(d) for d in args.sweep_days.split(',')]
+    if args.quick:
+        day_lengths, repeats, sweep_lengths = [7, 30], 1, [7, 30]
+    results = run_benchmarks(day_lengths, [int(r) for r in args.ramp_intervals.split(',')], repeats, sweep_lengths)
+    
+    report = {'created': pd.Timestamp.now().isoformat(), 'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+              'jit': ramp_rate_control.USE_JIT and ramp_rate_control.numba is not None, 'machine': platform.machine(), 'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=1)
+        print('Baseline saved to %s' % args.baseline)
+        return 0
+    if not os.path.exists(args.baseline):
+        print('No baseline at %s - run with --save-baseline to create one' % args.baseline)
+        return 0
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.threshold)
+    for name, reference, current in regressions:
+        print('REGRESSION %s: %.1f -> %.1f (%.0f%%)' % (name, reference, current, 100*(current/reference - 1)))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,87 @@
+"""
+Copyright (c) 2021, Electric Power Research Institute
+ All rights reserved.
+ Redistribution and use in source and binary forms, with or without modification,
+ are permitted provided that the following conditions are met:
+     * Redistributions of source code must retain the above copyright notice,
+       this list of conditions and the following disclaimer.
+     * Redistributions in binary form must reproduce the above copyright notice,
+       this list of conditions and the following disclaimer in the documentation
+       and/or other materials provided with the distribution.
+     * Neither the name of DER-VET nor the names of its contributors
+       may be used to endorse or promote products derived from this software
+       without specific prior written permission.
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+ "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+ LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+ A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+ CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+ EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+ PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+ PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+ LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+ NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+#synthetic PV power normalized to the AC nameplate, for benchmarking without measured data
+#clear-sky output follows the sun position for the given latitude. each day is drawn as clear, broken cloud or overcast (with persistence from the previous day),
+#and broken days get cloud passages of random length and depth whose edges ramp over one to a few minutes - the events that drive ramp rate violations
+#resolution is the sample spacing in seconds. the same seed always gives the same series
+def synthetic_pv(days=365, resolution=60, start='2019-01-01', latitude=35.0, seed=0):
+    rng = np.random.RandomState(seed)
+    index = pd.date_range(start=start, periods=int(days*86400/resolution), freq='%ds' % resolution)
+    hours = (index.hour + index.minute/60 + index.second/3600).values
+    day_of_year = index.dayofyear.values
+    
+    #sun position - declination and hour angle give the cosine of the zenith angle
+    declination = np.radians(23.45)*np.sin(2*np.pi*(284 + day_of_year)/365)
+    hour_angle = np.radians(15*(hours - 12))
+    lat = np.radians(latitude)
+    cos_zenith = np.sin(lat)*np.sin(declination) + np.cos(lat)*np.cos(declination)*np.cos(hour_angle)
+    clear_sky = np.clip(cos_zenith, 0, None)**1.15
+    
+    #day types: 0 clear, 1 broken cloud, 2 overcast
+    transition = np.array([[0.6, 0.3, 0.1], [0.3, 0.5, 0.2], [0.2, 0.4, 0.4]])
+    day_types = [0]
+    for _ in range(int(np.ceil(days)) - 1):
+        day_types.append(rng.choice(3, p=transition[day_types[-1]]))
+    
+    samples_per_day = int(86400/resolution)
+    clear_sky_index = np.ones(len(index))
+    for day, day_type in enumerate(day_types):
+        day_slice = slice(day*samples_per_day, min((day + 1)*samples_per_day, len(index)))
+        length = day_slice.stop - day_slice.start
+        if length <= 0:
+            break
+        if day_type == 2:
+            clear_sky_index[day_slice] = rng.uniform(0.15, 0.4) + 0.05*rng.randn(length).cumsum()/np.sqrt(length)
+        elif day_type == 1:
+            clear_sky_index[day_slice] = _cloud_passages(rng, length, resolution)
+    
+    noise = 1 + 0.005*rng.randn(len(index))
+    power = np.clip(clear_sky*np.clip(clear_sky_index, 0.05, 1.2)*noise, 0, 1.05)
+    return pd.Series(power, index=index, name='Power_scaled')
+
+#clear sky index over one broken-cloud day - alternating clear gaps and cloud passages with ramped edges
+def _cloud_passages(rng, length, resolution):
+    index = np.ones(length)
+    position = 0
+    while position < length:
+        position += int(rng.exponential(20*60/resolution)) #clear gap
+        duration = max(int(rng.exponential(8*60/resolution)), 1)
+        depth = rng.uniform(0.2, 0.8)
+        edge = max(int(rng.uniform(60, 240)/resolution), 1)
+        profile = np.full(duration + 2*edge, 1 - depth)
+        profile[:edge] = np.linspace(1, 1 - depth, edge)
+        profile[-edge:] = np.linspace(1 - depth, 1, edge)
+        end = min(position + len(profile), length)
+        if position < length:
+            index[position:end] = profile[:end - position]
+        position = end
+    #cloud enhancement at the edges of passages
+    return index + 0.1*np.clip(np.diff(index, prepend=1), 0, None)*rng.uniform(0.5, 1.5)
@@ -26,8 +26,9 @@ Copyright (c) 2021, Electric Power Research Institute
 
 import ramp_rate_control
 import ramp_rate_optimization
+import ramp_rate_data
+import ramp_rate_store
 import matplotlib.pyplot as plt
-import pandas as pd
 
 
 plt.close('all')
@@ -63,10 +64,10 @@ settings0 = settings.copy()
 #%% Data Import
 data_import = 1
 if data_import:
-    df = pd.read_csv("./sample_data.csv") #read sample 1-minute power signal
-    df.index = pd.date_range(start='1/1/2019 00:00', end='12/31/2019 23:59', freq='t')
-    df.columns = ['Time_stamp','Power'] #rename the columns
-    df = df[['Power']] #keep only the power column
+    #read sample 1-minute power signal - converted to a binary cache on the first run, memory-mapped afterwards
+    #the index is taken from the Time_stamp column. for files without usable timestamps pass e.g. start='1/1/2019 00:00', freq='t'
+    pv_record = ramp_rate_data.load_pv_data("./sample_data.csv", time_column=0, power_column=1)
+    df = pv_record.series().to_frame('Power')
     df['Power_scaled'] = df['Power'].divide(500) #normalize by the AC nameplate rating
     
     
@@ -79,12 +80,15 @@ print("Total Energy to Grid Percent %.2f (loss due to curtail and battery loss)"
 
 
 #%% Execute Parameter optimization (optimizes for violations, not energy)
-train_min, test_min, [kp_best, ki_best, kf_best, soc_rest_best] = ramp_rate_optimization.optimize_params(df['Power_scaled'], settings)
+#results are kept in a local store - re-running with the same data, settings and seed reuses them instead of simulating again
+store = ramp_rate_store.ResultStore('./ramp_rate_results.sqlite')
+seed = 0 #fixes the training/testing split, which the store needs to reuse results
+train_min, test_min, [kp_best, ki_best, kf_best, soc_rest_best] = ramp_rate_optimization.optimize_params(df['Power_scaled'], settings, seed=seed, store=store)
 
 
 #%% Execute battery size sweep
 battery_sweep = [0.2, 0.1, 0.05]#[0.3, 0.2, 0.1, 0.05, 0.025]
-battery_size_sweep, violation_sweeptrain, violation_sweeptest, energy_output_sweep = ramp_rate_optimization.size_sweep(df['Power_scaled'], settings.copy(), battery_sweep)
+battery_size_sweep, violation_sweeptrain, violation_sweeptest, energy_output_sweep = ramp_rate_optimization.size_sweep(df['Power_scaled'], settings.copy(), battery_sweep, seed=seed, store=store)
 
 fig, ax = plt.subplots()
 plt.plot(battery_size_sweep, violation_sweeptrain, marker='.', label='Training')
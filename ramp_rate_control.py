@@ -24,57 +24,52 @@ Copyright (c) 2021, Electric Power Research Institute
  SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
+import hashlib
+import time
+from collections import OrderedDict, deque, namedtuple
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 
+try:
+    import numba
+except ImportError: #numba is optional - the kernel runs as plain python without it
+    numba = None
 
-def run_smooth_controller(pv_input, settings, plotoutput, kp=1.2, ki=1.8, kf=0.3, soc_rest=0.5):    
-    #memory variables
-    previous_power = 0
-    battery_soc = 0
-    #outputs lists
-    outpower = []
-    battpower = []
-    battsoc = []
-    curtail = []
-    violation_list = []
-    
-    #conversion factors
-    power_to_energy_conversion_factor = settings['ramp_interval']/60
-    batt_half_round_trip_eff = settings['round_trip_efficiency']**0.5
-    
-    
-    #pre-processing:
-    #discretize PV input by length of ramp_interval
-    PV_ramp_interval = pv_input.resample(str(settings['ramp_interval'])+'t', label='right').mean()
-    #simulate a perfect forecasting signal by taking rolling sum of future pv power values
-    forecast_pv_energy = PV_ramp_interval[::-1].rolling(window=settings['forecast_shift_periods'], min_periods=0).sum()[::-1].multiply(settings['ramp_interval']/60)
-    
-    if settings['short_forecast'] == 0: #disable forecasting if settings is zero
-        kf=0
-        
-    #iterate through time-series
-    for pv_power, forecast_power in np.nditer([PV_ramp_interval.values, forecast_pv_energy.values]):
+#set to False to force the plain python kernel even when numba is installed
+USE_JIT = True
+
+
+#control law over pre-processed arrays - pv and forecast energy are float64 arrays, outputs are preallocated arrays of the same length
+#previous_power and battery_soc are the memory variables at the start of the arrays. with cutoff >= 0 the loop stops as soon as the running violation count exceeds it
+#returns the memory variables at the end and the number of intervals processed
+#written as a plain scalar loop so that the same function can be compiled by numba or executed directly by python
+def _smooth_kernel(pv, forecast, kp, ki, kf, soc_rest, max_ramp, power_to_energy_conversion_factor, forecast_shift_periods,
+                   AC_upper_bound_on, AC_upper_bound, AC_lower_bound_on, AC_lower_bound,
+                   battery_energy, battery_power, batt_half_round_trip_eff, curtail_as_control, curtail_if_violation,
+                   outpower, battpower, battsoc, violation_list, curtail, previous_power=0.0, battery_soc=0.0, cutoff=-1):
+    violation_total = 0
+    for i in range(len(pv)):
+        pv_power = pv[i]
+        forecast_power = forecast[i]
         #calculate controller error
         delta_power = pv_power - previous_power #proportional error
         soc_increment = battery_soc + (pv_power-previous_power)*power_to_energy_conversion_factor #integral error
-        future_error = previous_power*settings['forecast_shift_periods']*power_to_energy_conversion_factor - forecast_power #derivitive error
-        error = kp*delta_power + ki*(soc_increment-soc_rest*settings['battery_energy']) - kf*future_error
+        future_error = previous_power*forecast_shift_periods*power_to_energy_conversion_factor - forecast_power #derivitive error
+        error = kp*delta_power + ki*(soc_increment-soc_rest*battery_energy) - kf*future_error
         
         #calculate the desired output power, enforce ramp rate limit
         if error > 0:
-            out_power = previous_power + min(settings['max_ramp'],abs(error))
+            out_power = previous_power + min(max_ramp,abs(error))
         else:
-            out_power = previous_power - min(settings['max_ramp'],abs(error))
+            out_power = previous_power - min(max_ramp,abs(error))
         
         #enforce grid power limits
-        if settings['AC_upper_bound_on']:
-            if out_power > settings['AC_upper_bound']:
-                out_power = settings['AC_upper_bound']
-        if settings['AC_lower_bound_on']:
-            if out_power < settings['AC_lower_bound']:
-                out_power = settings['AC_lower_bound']
+        if AC_upper_bound_on:
+            if out_power > AC_upper_bound:
+                out_power = AC_upper_bound
+        if AC_lower_bound_on:
+            if out_power < AC_lower_bound:
+                out_power = AC_lower_bound
         
         #calculate desired (unconstrained) battery power
         battery_power_terminal = out_power - pv_power # positive is power leaving battery (discharging)
@@ -82,46 +77,44 @@ def run_smooth_controller(pv_input, settings, plotoutput, kp=1.2, ki=1.8, kf=0.3
         #adjust battery power to factor in battery constraints
         #check SOC limit - reduce battery power if either soc exceeds either 0 or 100%
         #check full
-        if (battery_soc - battery_power_terminal*batt_half_round_trip_eff*power_to_energy_conversion_factor) > settings['battery_energy']:
-            battery_power_terminal = -1*(settings['battery_energy'] - battery_soc)/power_to_energy_conversion_factor/batt_half_round_trip_eff
+        if (battery_soc - battery_power_terminal*batt_half_round_trip_eff*power_to_energy_conversion_factor) > battery_energy:
+            battery_power_terminal = -1*(battery_energy - battery_soc)/power_to_energy_conversion_factor/batt_half_round_trip_eff
         #check empty
         elif (battery_soc - battery_power_terminal*power_to_energy_conversion_factor/batt_half_round_trip_eff) < 0:
             battery_power_terminal = battery_soc/power_to_energy_conversion_factor*batt_half_round_trip_eff
         
         #enforce battery power limits
         #discharging too fast
-        if battery_power_terminal > settings['battery_power']:                
-            battery_power_terminal = settings['battery_power']            
+        if battery_power_terminal > battery_power:
+            battery_power_terminal = battery_power
         #charging too fast
-        elif battery_power_terminal < -1*settings['battery_power']:
-            battery_power_terminal = -1*settings['battery_power'] 
+        elif battery_power_terminal < -1*battery_power:
+            battery_power_terminal = -1*battery_power
          
         #update output power after battery constraints are applied
         out_power = pv_power + battery_power_terminal
         
         #flag if a ramp rate violation has occurred - up or down - because limits of battery prevented smoothing
         violation = 0
-        if abs(out_power - previous_power)>(settings['max_ramp']+0.00001):
+        if abs(out_power - previous_power)>(max_ramp+0.00001):
             violation = 1
-            
         
         #curtailment 
-        curtail_power = 0
+        curtail_power = 0.0
         
         #if curtailment is considered part of the control - don't count up-ramp violations
-        if settings['curtail_as_control']:
-            if (out_power - previous_power)>(settings['max_ramp']-0.00001):
-                out_power = previous_power+settings['max_ramp'] #reduce output to a non-violation
+        if curtail_as_control:
+            if (out_power - previous_power)>(max_ramp-0.00001):
+                out_power = previous_power+max_ramp #reduce output to a non-violation
                 curtail_power = pv_power + battery_power_terminal - out_power #curtail the remainder
                 violation = 0
         
-        
         #with this setting, curtail output power upon an upramp violation - rather than sending excess power to the grid
         #curtailment still counts as a violation
         #sum total of energy output is reduced
-        if settings['curtail_if_violation']:
-            if (out_power - previous_power)>(settings['max_ramp']-0.00001):
-                out_power = previous_power+settings['max_ramp'] #reduce output to a non-violation
+        if curtail_if_violation:
+            if (out_power - previous_power)>(max_ramp-0.00001):
+                out_power = previous_power+max_ramp #reduce output to a non-violation
                 curtail_power = pv_power + battery_power_terminal - out_power #curtail the remainder
         
         #update memory variables
@@ -132,37 +125,730 @@ def run_smooth_controller(pv_input, settings, plotoutput, kp=1.2, ki=1.8, kf=0.3
         previous_power = out_power
         
         #update output variables
-        outpower.append(out_power)
-        battpower.append(battery_power_terminal)
-        battsoc.append(battery_soc)
-        violation_list.append(violation)
-        curtail.append(curtail_power)
+        outpower[i] = out_power
+        battpower[i] = battery_power_terminal
+        battsoc[i] = battery_soc
+        violation_list[i] = violation
+        curtail[i] = curtail_power
+        
+        violation_total += violation
+        if cutoff >= 0 and violation_total > cutoff:
+            return previous_power, battery_soc, i+1
+    
+    return previous_power, battery_soc, len(pv)
+
+
+if numba is not None:
+    _smooth_kernel_jit = numba.njit(cache=True)(_smooth_kernel)
+else:
+    _smooth_kernel_jit = None
+
+
+#unpack the settings dict into the scalar arguments of the kernel (everything after the controller gains)
+def _kernel_settings(settings):
+    return (float(settings['max_ramp']),
+            settings['ramp_interval']/60,
+            int(settings['forecast_shift_periods']),
+            bool(settings['AC_upper_bound_on']),
+            float(settings['AC_upper_bound']),
+            bool(settings['AC_lower_bound_on']),
+            float(settings['AC_lower_bound']),
+            float(settings['battery_energy']),
+            float(settings['battery_power']),
+            settings['round_trip_efficiency']**0.5,
+            bool(settings['curtail_as_control']),
+            bool(settings['curtail_if_violation']))
+
+
+#counters of controller runs given a violation cutoff - how many ran, how many were stopped early and how many intervals were skipped
+class PruneStats:
+    def __init__(self):
+        self.clear()
     
-    #post-processing
-    violation_count = np.sum(violation_list)
+    def add(self, runs, pruned, intervals_saved):
+        self.runs += runs
+        self.pruned += pruned
+        self.intervals_saved += intervals_saved
     
+    def clear(self):
+        self.runs = 0
+        self.pruned = 0
+        self.intervals_saved = 0
     
-    if plotoutput:
-        outpower_series = pd.Series(outpower, index=pv_input.resample(str(settings['ramp_interval'])+'t', label='right').mean().index)
-        battery_soc_series = pd.Series(battsoc, index=pv_input.resample(str(settings['ramp_interval'])+'t', label='right').mean().index).multiply(1/settings['battery_energy'])
-        violation_series = pd.Series(violation_list, index=pv_input.resample(str(settings['ramp_interval'])+'t', label='right').mean().index)
-        battpower_series = pd.Series(battpower, index=pv_input.resample(str(settings['ramp_interval'])+'t', label='right').mean().index)
-        curtail_series = pd.Series(curtail, index=pv_input.resample(str(settings['ramp_interval'])+'t', label='right').mean().index)
+    def info(self):
+        return {'runs': self.runs, 'pruned': self.pruned, 'intervals_saved': self.intervals_saved}
+
+
+prune_stats = PruneStats()
 
+
+#timers, counters and progress events for profiling runs - disabled by default, and while disabled every hook costs a single attribute check
+#timers (seconds): 'resample' and 'forecast' (pre-processing, only when not served by the cache), 'control' (the control loop) and 'plot'
+#counters: 'runs' (controller runs, one per candidate) and 'intervals' (ramp intervals simulated)
+#callback(name, fields) receives the progress events of the optimization: 'level' (a grid search level), 'search' (a batch of derivative-free
+#evaluations), 'optimum' (the result of optimize_params) and 'size' (a battery size of size_sweep)
+class Instrumentation:
+    def __init__(self):
+        self.enabled = False
+        self.callback = None
+        self.clear()
     
-        fig, ax = plt.subplots()
-        plt.plot(PV_ramp_interval, label='PV Power')
-        plt.plot(outpower_series, label='Output Power')
-        plt.plot(battery_soc_series, label='SOC')
-        plt.plot(outpower_series[violation_series>0],'o', label='violations')
-        plt.plot(battpower_series, label='Battery Power')
-        plt.plot(curtail_series, label='Curtail Power')
-        ax.legend(loc='upper right')
+    def enable(self, callback=None):
+        self.enabled = True
+        self.callback = callback
+        self.clear()
+    
+    def disable(self):
+        self.enabled = False
+        self.callback = None
+    
+    def clear(self):
+        self.timers = {}
+        self.counters = {}
+        self.start = time.perf_counter()
+    
+    def add_time(self, phase, seconds):
+        self.timers[phase] = self.timers.get(phase, 0.0) + seconds
+    
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+    
+    def event(self, name, **fields):
+        if self.enabled and self.callback is not None:
+            self.callback(name, fields)
+    
+    #add the timers and counters reported by info() in another process
+    def merge(self, info):
+        for phase, seconds in info['timers'].items():
+            self.add_time(phase, seconds)
+        for name, n in info['counters'].items():
+            self.count(name, n)
+    
+    #runs_per_second is over the wall time since the instrumentation was enabled or cleared
+    def info(self):
+        elapsed = time.perf_counter() - self.start
+        runs = self.counters.get('runs', 0)
+        return {'timers': dict(self.timers), 'counters': dict(self.counters), 'elapsed': elapsed, 'runs_per_second': runs/elapsed if elapsed > 0 else 0.0}
+
+
+instrumentation = Instrumentation()
+
+
+#callback for instrumentation.enable() that prints each progress event on one line
+def print_event(name, fields):
+    print(name + ': ' + ', '.join('%s=%s' % item for item in fields.items()))
+
+
+#run the control law over float64 arrays - returns the preallocated output arrays
+#outpower, battpower, battsoc, violations (int64) and curtail
+#with a cutoff the run stops once more than cutoff violations have occurred and the arrays end at that interval
+#dtype sets the type of the float outputs - the control law always computes in float64, float32 only halves the memory of the stored results
+def smooth_arrays(pv, forecast, settings, kp=1.2, ki=1.8, kf=0.3, soc_rest=0.5, cutoff=None, dtype=np.float64):
+    pv = np.ascontiguousarray(pv, dtype=np.float64)
+    forecast = np.ascontiguousarray(forecast, dtype=np.float64)
+    n = len(pv)
+    outpower = np.empty(n, dtype=dtype)
+    battpower = np.empty(n, dtype=dtype)
+    battsoc = np.empty(n, dtype=dtype)
+    violation_list = np.empty(n, dtype=np.int64)
+    curtail = np.empty(n, dtype=dtype)
+    args = (float(kp), float(ki), float(kf), float(soc_rest)) + _kernel_settings(settings)
+    limit = -1 if cutoff is None else int(cutoff)
+    timed = instrumentation.enabled
+    if timed:
+        start = time.perf_counter()
+    if USE_JIT and _smooth_kernel_jit is not None:
+        steps = _smooth_kernel_jit(pv, forecast, *args, outpower, battpower, battsoc, violation_list, curtail, 0.0, 0.0, limit)[2]
+    else:
+        #python floats are much faster to iterate than numpy scalars
+        steps = _smooth_kernel(pv.tolist(), forecast.tolist(), *args, outpower, battpower, battsoc, violation_list, curtail, 0.0, 0.0, limit)[2]
+    if timed:
+        instrumentation.add_time('control', time.perf_counter() - start)
+        instrumentation.count('runs')
+        instrumentation.count('intervals', steps)
+    if cutoff is not None:
+        prune_stats.add(1, int(steps < n), n - steps)
+    return outpower[:steps], battpower[:steps], battsoc[:steps], violation_list[:steps], curtail[:steps]
+
+
+#vectorized control law for many parameter sets - the time loop is on the outside and every operation acts on the candidate axis
+#kp, ki, kf and soc_rest are float64 arrays of equal length. outpower is a preallocated (candidates x time) array, violation_count an int64 array
+#forecast is either one array shared by every candidate or a (candidates x time) array with a forecast per candidate
+#if groups is given, violations are also added to group_violations (candidates x groups) in the column of each interval's group
+#with cutoff >= 0 a candidate is dropped as soon as its violation count exceeds the cutoff and the number of intervals it ran is written to steps
+#each candidate follows exactly the same arithmetic as _smooth_kernel, so results match a separate run bit for bit
+def _smooth_kernel_batch(pv, forecast, kp, ki, kf, soc_rest, max_ramp, power_to_energy_conversion_factor, forecast_shift_periods,
+                         AC_upper_bound_on, AC_upper_bound, AC_lower_bound_on, AC_lower_bound,
+                         battery_energy, battery_power, batt_half_round_trip_eff, curtail_as_control, curtail_if_violation,
+                         outpower, violation_count, groups=None, group_violations=None, cutoff=-1, steps=None):
+    #memory variables
+    previous_power = np.zeros(len(kp))
+    battery_soc = np.zeros(len(kp))
+    rows = None #candidates still running, once any has been dropped
+    per_candidate = forecast.ndim == 2
+    forecast_values = np.ascontiguousarray(forecast.T) if per_candidate else forecast.tolist()
+    
+    for i, pv_power in enumerate(pv.tolist()):
+        if not per_candidate:
+            forecast_power = forecast_values[i]
+        elif rows is None:
+            forecast_power = forecast_values[i]
+        else:
+            forecast_power = forecast_values[i, rows]
+        #calculate controller error
+        delta_power = pv_power - previous_power
+        soc_increment = battery_soc + (pv_power-previous_power)*power_to_energy_conversion_factor
+        future_error = previous_power*forecast_shift_periods*power_to_energy_conversion_factor - forecast_power
+        error = kp*delta_power + ki*(soc_increment-soc_rest*battery_energy) - kf*future_error
+        
+        #calculate the desired output power, enforce ramp rate limit
+        ramp = np.minimum(max_ramp, np.abs(error))
+        out_power = np.where(error > 0, previous_power + ramp, previous_power - ramp)
+        
+        #enforce grid power limits
+        if AC_upper_bound_on:
+            out_power = np.where(out_power > AC_upper_bound, AC_upper_bound, out_power)
+        if AC_lower_bound_on:
+            out_power = np.where(out_power < AC_lower_bound, AC_lower_bound, out_power)
+        
+        #calculate desired (unconstrained) battery power, then apply SOC limits and battery power limits
+        battery_power_terminal = out_power - pv_power
+        full = (battery_soc - battery_power_terminal*batt_half_round_trip_eff*power_to_energy_conversion_factor) > battery_energy
+        empty = (battery_soc - battery_power_terminal*power_to_energy_conversion_factor/batt_half_round_trip_eff) < 0
+        battery_power_terminal = np.where(full, -1*(battery_energy - battery_soc)/power_to_energy_conversion_factor/batt_half_round_trip_eff,
+                                          np.where(empty, battery_soc/power_to_energy_conversion_factor*batt_half_round_trip_eff, battery_power_terminal))
+        battery_power_terminal = np.where(battery_power_terminal > battery_power, battery_power,
+                                          np.where(battery_power_terminal < -1*battery_power, -1*battery_power, battery_power_terminal))
+        
+        #update output power after battery constraints are applied and flag violations
+        out_power = pv_power + battery_power_terminal
+        violation = np.abs(out_power - previous_power)>(max_ramp+0.00001)
+        
+        #curtailment
+        if curtail_as_control or curtail_if_violation:
+            up_ramp = (out_power - previous_power)>(max_ramp-0.00001)
+            out_power = np.where(up_ramp, previous_power+max_ramp, out_power)
+            if curtail_as_control:
+                violation = violation & ~up_ramp
+        
+        #update memory variables
+        battery_soc = np.where(battery_power_terminal > 0, battery_soc - battery_power_terminal*power_to_energy_conversion_factor/batt_half_round_trip_eff,
+                               np.where(battery_power_terminal < 0, battery_soc - battery_power_terminal*power_to_energy_conversion_factor*batt_half_round_trip_eff, battery_soc))
+        previous_power = out_power
+        
+        if rows is None:
+            outpower[:, i] = out_power
+            violation_count += violation
+            if groups is not None:
+                group_violations[:, groups[i]] += violation
+        else:
+            outpower[rows, i] = out_power
+            violation_count[rows] += violation
+            if groups is not None:
+                group_violations[rows, groups[i]] += violation
+        
+        if cutoff >= 0:
+            exceeded = (violation_count if rows is None else violation_count[rows]) > cutoff
+            if exceeded.any():
+                if rows is None:
+                    rows = np.arange(len(kp))
+                steps[rows[exceeded]] = i+1
+                keep = ~exceeded
+                rows, kp, ki, kf, soc_rest = rows[keep], kp[keep], ki[keep], kf[keep], soc_rest[keep]
+                previous_power, battery_soc = previous_power[keep], battery_soc[keep]
+                if len(rows) == 0:
+                    break
+
+
+#simulate a perfect forecasting signal - energy of the current and next forecast_shift_periods-1 intervals, missing intervals count as zero
+#each window is summed left to right (oldest interval first) so that SmoothController can reproduce it exactly as the intervals arrive
+def _forecast_energy(pv, forecast_shift_periods, ramp_interval):
+    pv = np.where(np.isnan(pv), 0.0, pv)
+    forecast = np.zeros(len(pv))
+    for shift in range(min(int(forecast_shift_periods), len(pv))):
+        forecast[:len(pv)-shift] += pv[shift:]
+    return forecast*(ramp_interval/60)
+
+
+#bounded cache of pre-processed inputs with least recently used eviction
+#entries are keyed by a fingerprint of the input series plus the settings that affect the result, hits and misses are counted
+class PreprocessCache:
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
     
-    total_energy = np.sum(outpower)*settings['ramp_interval']/60
+    def get(self, key):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+        self.misses += 1
+        return None
     
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+    
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+    
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'maxsize': self.maxsize}
+
+
+#shared by every entry point of this module - set preprocess_cache.maxsize = 0 to disable
+preprocess_cache = PreprocessCache()
+
+
+#hash of the values and timestamps of a series - equal data gives an equal fingerprint regardless of the series object
+def fingerprint(series):
+    digest = hashlib.blake2b(digest_size=16)
+    values = np.ascontiguousarray(series.values)
+    digest.update(str((values.dtype, series.index.dtype, len(values))).encode())
+    digest.update(memoryview(values).cast('B'))
+    digest.update(memoryview(np.ascontiguousarray(series.index.asi8)).cast('B'))
+    return digest.hexdigest()
+
+
+#pre-processing shared by every entry point - returns the PV series discretized by ramp_interval and the forecast energy series
+#results are cached, so the returned series must not be modified
+def _preprocess(pv_input, settings):
+    data_key = fingerprint(pv_input)
+    resample_key = ('resample', data_key, settings['ramp_interval'])
+    forecast_key = ('forecast', data_key, settings['ramp_interval'], settings['forecast_shift_periods'])
+    PV_ramp_interval = preprocess_cache.get(resample_key)
+    timed = instrumentation.enabled
+    if PV_ramp_interval is None:
+        if timed:
+            start = time.perf_counter()
+        #discretize PV input by length of ramp_interval
+        PV_ramp_interval = pv_input.resample(str(settings['ramp_interval'])+'t', label='right').mean()
+        preprocess_cache.put(resample_key, PV_ramp_interval)
+        if timed:
+            instrumentation.add_time('resample', time.perf_counter() - start)
+    forecast_pv_energy = preprocess_cache.get(forecast_key)
+    if forecast_pv_energy is None:
+        if timed:
+            start = time.perf_counter()
+        forecast_pv_energy = pd.Series(_forecast_energy(PV_ramp_interval.values.astype(np.float64), settings['forecast_shift_periods'], settings['ramp_interval']), index=PV_ramp_interval.index)
+        preprocess_cache.put(forecast_key, forecast_pv_energy)
+        if timed:
+            instrumentation.add_time('forecast', time.perf_counter() - start)
+    return PV_ramp_interval, forecast_pv_energy
+
+
+#below this many candidates the python kernel is run once per candidate instead of the vectorized kernel
+#the crossover depends on the machine - on one year of 10 minute data it has been measured at about 32 candidates on one machine while
+#another still ran the python kernel faster at 32, and at the 8 candidates of a grid level the vectorized kernel is several times slower everywhere
+BATCH_VECTORIZE_MIN = 64
+
+
+#score many controller parameter sets with one pass over the data
+#kp, ki, kf and soc_rest are scalars or equal length arrays - returns an int64 array of violation counts and a float array of total energy, one entry per candidate
+#with numba available each candidate is run through the compiled kernel. otherwise large batches are advanced together by the vectorized kernel
+#and small batches are run one candidate at a time through the python kernel
+#with a cutoff, a candidate stops as soon as it has more than cutoff violations - its count is then cutoff+1 and its energy NaN
+#forecast replaces the perfect forecast - forecast energy per ramp interval (see ramp_rate_forecast), either one array for every candidate or a
+#(candidates x intervals) array with a row per candidate, in which case the parameters are broadcast to the number of rows
+def run_smooth_controller_batch(pv_input, settings, kp, ki, kf, soc_rest, cutoff=None, forecast=None):
+    PV_ramp_interval, forecast_pv_energy = _preprocess(pv_input, settings)
+    if forecast is None:
+        forecast = forecast_pv_energy.values
+    violation_count, total_energy, _, _ = _simulate_batch(PV_ramp_interval.values, forecast, settings, kp, ki, kf, soc_rest, cutoff=cutoff)
     return violation_count, total_energy
 
 
+#like run_smooth_controller_batch, but violations and energy are totalled per calendar day so that any subset of days can be scored from one run
+#each ramp interval is counted on the day it starts in (the resampled index labels intervals by their end)
+#returns the days as a DatetimeIndex, an int64 (candidates x days) array of violations and a float (candidates x days) array of energy
+def run_smooth_controller_daily(pv_input, settings, kp, ki, kf, soc_rest):
+    PV_ramp_interval, forecast_pv_energy = _preprocess(pv_input, settings)
+    interval_days = (PV_ramp_interval.index - pd.Timedelta(minutes=settings['ramp_interval'])).normalize()
+    day_codes, days = pd.factorize(interval_days, sort=True)
+    _, _, daily_violations, daily_energy = _simulate_batch(PV_ramp_interval.values, forecast_pv_energy.values, settings, kp, ki, kf, soc_rest, day_codes, len(days))
+    return pd.DatetimeIndex(days), daily_violations, daily_energy
+
+
+#shared by the batch entry points - groups optionally assigns every interval to one of n_groups, and violations and energy are then also totalled per group
+#candidates stopped by the cutoff keep their partial violation counts and report NaN energy
+def _simulate_batch(pv, forecast, settings, kp, ki, kf, soc_rest, groups=None, n_groups=0, cutoff=None):
+    forecast = np.ascontiguousarray(forecast, dtype=np.float64)
+    per_candidate = forecast.ndim == 2
+    members = np.empty(len(forecast) if per_candidate else 1) #a forecast row per candidate sets the batch size
+    kp, ki, kf, soc_rest = [np.array(x, dtype=np.float64).ravel() for x in np.broadcast_arrays(kp, ki, kf, soc_rest)]
+    kp, ki, kf, soc_rest = [np.array(x) for x in np.broadcast_arrays(kp, ki, kf, soc_rest, members)[:4]]
+    if settings['short_forecast'] == 0: #disable forecasting if settings is zero
+        kf = np.zeros_like(kf)
+    
+    pv = np.ascontiguousarray(pv, dtype=np.float64)
+    candidates = len(kp)
+    n = len(pv)
+    ramp_interval = settings['ramp_interval']
+    violation_count = np.zeros(candidates, dtype=np.int64)
+    total_energy = np.zeros(candidates)
+    group_violations = np.zeros((candidates, n_groups), dtype=np.int64)
+    group_energy = np.zeros((candidates, n_groups))
+    limit = -1 if cutoff is None else int(cutoff)
+    steps = np.full(candidates, n)
+    timed = instrumentation.enabled
+    if timed:
+        start = time.perf_counter()
+    jit = USE_JIT and _smooth_kernel_jit is not None
+    if jit or candidates < BATCH_VECTORIZE_MIN:
+        kernel = _smooth_kernel_jit if jit else _smooth_kernel
+        if not jit:
+            pv = pv.tolist()
+            if not per_candidate:
+                forecast = forecast.tolist()
+        outpower = np.empty(n)
+        battpower = np.empty(n)
+        battsoc = np.empty(n)
+        violation_list = np.empty(n, dtype=np.int64)
+        curtail = np.empty(n)
+        for c in range(candidates):
+            if per_candidate:
+                candidate_forecast = forecast[c] if jit else forecast[c].tolist()
+            else:
+                candidate_forecast = forecast
+            steps[c] = kernel(pv, candidate_forecast, kp[c], ki[c], kf[c], soc_rest[c], *_kernel_settings(settings),
+                              outpower, battpower, battsoc, violation_list, curtail, 0.0, 0.0, limit)[2]
+            violation_count[c] = np.sum(violation_list[:steps[c]])
+            total_energy[c] = np.sum(outpower)*ramp_interval/60
+            if groups is not None:
+                group_violations[c] = np.bincount(groups[:steps[c]], weights=violation_list[:steps[c]], minlength=n_groups)
+                group_energy[c] = np.bincount(groups, weights=outpower, minlength=n_groups)*ramp_interval/60
+    else:
+        #one row per candidate so each row sums exactly like a single run
+        outpower = np.empty((candidates, n))
+        _smooth_kernel_batch(pv, forecast, kp, ki, kf, soc_rest, *_kernel_settings(settings), outpower, violation_count,
+                             groups, group_violations, limit, steps)
+        for c in range(candidates):
+            total_energy[c] = np.sum(outpower[c])*ramp_interval/60
+            if groups is not None:
+                group_energy[c] = np.bincount(groups, weights=outpower[c], minlength=n_groups)*ramp_interval/60
+    if timed:
+        instrumentation.add_time('control', time.perf_counter() - start)
+        instrumentation.count('runs', candidates)
+        instrumentation.count('intervals', int(steps.sum()))
+    pruned = steps < n
+    total_energy[pruned] = np.nan
+    group_energy[pruned] = np.nan
+    if cutoff is not None:
+        prune_stats.add(candidates, int(pruned.sum()), int((n - steps).sum()))
+    return violation_count, total_energy, group_violations, group_energy
+
+
+#cumulative sums over a raw, time-sorted PV series - interval means for any ramp interval and forecast window energies for any number of
+#forecast periods are differences of two prefix sums, so each resolution costs O(n) and no resampling
+#bins match the pandas resample used by run_smooth_controller: they start at midnight of the first sample, are labelled by their right edge
+#and empty bins are NaN. sums of differences round differently from pandas, so the means can differ from the resampled ones in the last digits
+class PrefixIndex:
+    def __init__(self, pv_input):
+        values = np.asarray(pv_input.values, dtype=np.float64)
+        valid = ~np.isnan(values)
+        self.tz = pv_input.index.tz
+        self._time = pv_input.index.asi8
+        self._origin = pv_input.index[0].normalize().value
+        self._sum = np.concatenate(([0.0], np.cumsum(np.where(valid, values, 0.0))))
+        self._count = np.concatenate(([0], np.cumsum(valid)))
+    
+    #PV averaged over ramp_interval (minutes), as a series labelled like the resampled one
+    def interval_means(self, ramp_interval):
+        freq = int(round(ramp_interval*60e9))
+        bins = (self._time - self._origin)//freq
+        first = bins[0]
+        edges = np.concatenate(([0], np.cumsum(np.bincount(bins - first))))
+        counts = np.diff(self._count[edges])
+        sums = self._sum[edges[1:]] - self._sum[edges[:-1]]
+        means = np.full(len(counts), np.nan)
+        np.divide(sums, counts, out=means, where=counts > 0)
+        labels = self._origin + (np.arange(first, first + len(counts)) + 1)*freq
+        if self.tz is None:
+            index = pd.DatetimeIndex(labels)
+        else:
+            index = pd.DatetimeIndex(pd.to_datetime(labels, utc=True)).tz_convert(self.tz)
+        return pd.Series(means, index=index)
+    
+    #forecast energy of the current and next forecast_shift_periods-1 intervals, as _forecast_energy computes it from the interval means
+    @staticmethod
+    def forecast_energy(interval_means, forecast_shift_periods, ramp_interval):
+        values = np.nan_to_num(np.asarray(interval_means, dtype=np.float64))
+        cumulative = np.concatenate(([0.0], np.cumsum(values)))
+        end = np.minimum(np.arange(len(values)) + int(forecast_shift_periods), len(values))
+        return (cumulative[end] - cumulative[:len(values)])*(ramp_interval/60)
+
+
+#score a controller configuration at several ramp intervals from one PrefixIndex of the raw series
+#kp, ki, kf and soc_rest may be arrays, as for run_smooth_controller_batch. every other setting, including max_ramp, is taken from settings
+#returns a tidy DataFrame with one row per ramp interval and parameter set: ramp_interval, kp, ki, kf, soc_rest, violations, energy and intervals
+def run_smooth_controller_resolutions(pv_input, settings, ramp_intervals, kp=1.2, ki=1.8, kf=0.3, soc_rest=0.5):
+    key = ('prefix', fingerprint(pv_input))
+    prefix = preprocess_cache.get(key)
+    if prefix is None:
+        prefix = PrefixIndex(pv_input)
+        preprocess_cache.put(key, prefix)
+    kp, ki, kf, soc_rest = [np.array(x, dtype=np.float64).ravel() for x in np.broadcast_arrays(kp, ki, kf, soc_rest)]
+    tables = []
+    for ramp_interval in ramp_intervals:
+        interval_settings = dict(settings, ramp_interval=ramp_interval)
+        means = prefix.interval_means(ramp_interval)
+        forecast = prefix.forecast_energy(means.values, settings['forecast_shift_periods'], ramp_interval)
+        violation_count, total_energy, _, _ = _simulate_batch(means.values, forecast, interval_settings, kp, ki, kf, soc_rest)
+        tables.append(pd.DataFrame({'ramp_interval': ramp_interval, 'kp': kp, 'ki': ki, 'kf': kf, 'soc_rest': soc_rest,
+                                    'violations': violation_count, 'energy': total_energy, 'intervals': len(means)}))
+    return pd.concat(tables, ignore_index=True)
+
+
+#with a cutoff, the run stops as soon as more than cutoff violations have occurred - the violation count is then cutoff+1 and the energy NaN
+#run_smooth_controller_result returns the output arrays as well
+def run_smooth_controller(pv_input, settings, plotoutput, kp=1.2, ki=1.8, kf=0.3, soc_rest=0.5, cutoff=None):    
+    result = run_smooth_controller_result(pv_input, settings, kp, ki, kf, soc_rest, cutoff)
+    if plotoutput and not result.pruned:
+        result.plot()
+    return result.violation_count, result.total_energy
+
 
+#same run as run_smooth_controller, returning a SmoothResult with every output series instead of the totals only
+#float32 stores the output arrays in single precision, for long records
+def run_smooth_controller_result(pv_input, settings, kp=1.2, ki=1.8, kf=0.3, soc_rest=0.5, cutoff=None, float32=False):
+    #pre-processing:
+    PV_ramp_interval, forecast_pv_energy = _preprocess(pv_input, settings)
+    
+    if settings['short_forecast'] == 0: #disable forecasting if settings is zero
+        kf=0
+        
+    #iterate through time-series
+    dtype = np.float32 if float32 else np.float64
+    outputs = smooth_arrays(PV_ramp_interval.values, forecast_pv_energy.values, settings, kp, ki, kf, soc_rest, cutoff, dtype)
+    #the resampled pv is copied since the cached series is shared with later runs
+    return SmoothResult(PV_ramp_interval.index, np.array(PV_ramp_interval.values, dtype=dtype), *outputs,
+                        battery_energy=settings['battery_energy'], ramp_interval=settings['ramp_interval'])
+
+
+#outputs of one controller run - numpy arrays over the resampled ramp intervals, which are shared by index
+#when the run was stopped by a cutoff (pruned) the arrays end at the interval where it stopped
+class SmoothResult:
+    def __init__(self, index, pv_power, out_power, battery_power, battery_soc, violations, curtail_power, battery_energy, ramp_interval):
+        self.pruned = len(out_power) < len(index)
+        self.index = index[:len(out_power)]
+        self.pv_power = pv_power[:len(out_power)]
+        self.out_power = out_power
+        self.battery_power = battery_power
+        self.battery_soc = battery_soc
+        self.violations = violations
+        self.curtail_power = curtail_power
+        self.battery_energy = battery_energy
+        self.ramp_interval = ramp_interval
+    
+    def __len__(self):
+        return len(self.out_power)
+    
+    @property
+    def violation_count(self):
+        return int(np.sum(self.violations))
+    
+    #energy delivered to the grid (hours times the normalized power) - NaN for a pruned run
+    @property
+    def total_energy(self):
+        if self.pruned:
+            return np.nan
+        return np.sum(self.out_power, dtype=np.float64)*self.ramp_interval/60
+    
+    def to_frame(self):
+        return pd.DataFrame({'pv_power': self.pv_power, 'out_power': self.out_power, 'battery_power': self.battery_power,
+                             'battery_soc': self.battery_soc, 'violation': self.violations, 'curtail_power': self.curtail_power}, index=self.index)
+    
+    #plot the run - matplotlib is only imported here, so runs that never plot do not pay for it. returns the axes
+    def plot(self):
+        import matplotlib.pyplot as plt
+        timed = instrumentation.enabled
+        if timed:
+            start = time.perf_counter()
+        violated = self.violations > 0
+        fig, ax = plt.subplots()
+        ax.plot(self.index, self.pv_power, label='PV Power')
+        ax.plot(self.index, self.out_power, label='Output Power')
+        ax.plot(self.index, self.battery_soc/self.battery_energy, label='SOC')
+        ax.plot(self.index[violated], self.out_power[violated], 'o', label='violations')
+        ax.plot(self.index, self.battery_power, label='Battery Power')
+        ax.plot(self.index, self.curtail_power, label='Curtail Power')
+        ax.legend(loc='upper right')
+        if timed:
+            instrumentation.add_time('plot', time.perf_counter() - start)
+        return ax
+
+
+#one ramp interval emitted by SmoothController - time is the right edge of the interval, as in the resampled batch index
+Setpoint = namedtuple('Setpoint', ['time', 'pv_power', 'out_power', 'battery_power', 'battery_soc', 'violation', 'curtail_power'])
+
+
+#stateful version of run_smooth_controller for live telemetry
+#samples are pushed one at a time with update() or as a time-indexed series with update_chunk(). they are averaged into ramp_interval bins
+#exactly like the batch resample (bins start at midnight of the first sample, empty bins are NaN) and a setpoint is emitted for each completed bin
+#with short_forecast enabled the perfect forecast needs the following forecast_shift_periods-1 bins, so setpoints are emitted that many intervals late.
+#flush() closes the record. fed the same data the emitted setpoints match the batch outputs exactly
+class SmoothController:
+    def __init__(self, settings, kp=1.2, ki=1.8, kf=0.3, soc_rest=0.5):
+        if settings['short_forecast'] == 0: #disable forecasting if settings is zero
+            kf = 0
+        self.settings = settings.copy()
+        self._args = (float(kp), float(ki), float(kf), float(soc_rest)) + _kernel_settings(settings)
+        self._kernel = _smooth_kernel_jit if USE_JIT and _smooth_kernel_jit is not None else _smooth_kernel
+        self._conversion = settings['ramp_interval']/60
+        self._freq = pd.Timedelta(minutes=settings['ramp_interval']).value
+        self._forecast_periods = int(settings['forecast_shift_periods'])
+        #number of bins needed before the oldest pending bin can be controlled
+        self._window = max(self._forecast_periods, 1) if settings['short_forecast'] else 1
+        self._tz = None
+        self.reset()
+    
+    #clear all state - the next sample starts a new record
+    def reset(self):
+        self.previous_power = 0.0
+        self.battery_soc = 0.0
+        self._origin = None #midnight of the first sample (ns)
+        self._bin = None #index of the bin being accumulated
+        self._sum = 0.0
+        self._compensation = 0.0
+        self._count = 0
+        self._pending = deque() #(bin, mean pv power) waiting for the forecast window to fill
+    
+    def snapshot(self):
+        return {'previous_power': self.previous_power, 'battery_soc': self.battery_soc, 'origin': self._origin, 'tz': self._tz,
+                'bin': self._bin, 'sum': self._sum, 'compensation': self._compensation, 'count': self._count,
+                'pending': list(self._pending)}
+    
+    def restore(self, state):
+        self.previous_power = state['previous_power']
+        self.battery_soc = state['battery_soc']
+        self._origin = state['origin']
+        self._tz = state['tz']
+        self._bin = state['bin']
+        self._sum = state['sum']
+        self._compensation = state['compensation']
+        self._count = state['count']
+        self._pending = deque(state['pending'])
+    
+    #add one sample - returns the list of setpoints that became available (usually empty)
+    def update(self, timestamp, value):
+        timestamp = pd.Timestamp(timestamp)
+        if self._origin is None:
+            self._tz = timestamp.tz
+        return self._add(timestamp.value, float(value), timestamp)
+    
+    #add a time-indexed series of samples - returns a DataFrame of the setpoints that became available, indexed by time
+    #bins that lie entirely inside the chunk are averaged in one vectorized step, only the first and last bin are accumulated sample by sample
+    def update_chunk(self, samples):
+        emitted = []
+        if len(samples):
+            if self._origin is None:
+                self._tz = samples.index.tz
+                self._start(samples.index[0])
+            times = samples.index.asi8
+            values = samples.values.astype(np.float64)
+            if np.any(np.diff(times) < 0):
+                raise ValueError('samples must be in time order')
+            bins = (times - self._origin)//self._freq
+            head = np.searchsorted(bins, bins[0], side='right')
+            tail = np.searchsorted(bins, bins[-1], side='left')
+            for time_ns, value in zip(times[:head].tolist(), values[:head].tolist()):
+                emitted += self._add(time_ns, value)
+            if head < tail:
+                #same compensated mean as the batch resample
+                means = pd.Series(values[head:tail]).groupby(bins[head:tail]).mean()
+                self._close_bin()
+                middle = np.full(bins[-1] - bins[0] - 1, np.nan)
+                middle[means.index.values - bins[0] - 1] = means.values
+                self._pending.extend(zip(range(bins[0]+1, bins[-1]), middle.tolist()))
+                self._bin = int(bins[-1])
+                emitted += self._control(self._window)
+            for time_ns, value in zip(times[max(head, tail):].tolist(), values[max(head, tail):].tolist()):
+                emitted += self._add(time_ns, value)
+        return self._frame(emitted)
+    
+    #end of record - emits the partially filled bin and the bins still waiting on the forecast window
+    def flush(self):
+        emitted = []
+        if self._bin is not None:
+            self._close_bin()
+            self._bin = None
+        while self._pending:
+            emitted += self._control(1)
+        return emitted
+    
+    def _start(self, timestamp):
+        self._origin = timestamp.normalize().value
+    
+    def _add(self, time_ns, value, timestamp=None):
+        if self._origin is None:
+            self._start(timestamp if timestamp is not None else pd.Timestamp(time_ns, tz=self._tz))
+        sample_bin = (time_ns - self._origin)//self._freq
+        emitted = []
+        if self._bin is None:
+            self._bin = sample_bin
+        elif sample_bin != self._bin:
+            if sample_bin < self._bin:
+                raise ValueError('samples must be in time order')
+            #close the current bin and any empty bins in between
+            self._close_bin()
+            for empty_bin in range(self._bin+1, sample_bin):
+                self._pending.append((empty_bin, np.nan))
+            self._bin = sample_bin
+            emitted = self._control(self._window)
+        #compensated sum, as used by the pandas mean aggregation
+        if value == value:
+            self._count += 1
+            y = value - self._compensation
+            t = self._sum + y
+            self._compensation = t - self._sum - y
+            if self._compensation != self._compensation:
+                self._compensation = 0.0
+            self._sum = t
+        return emitted
+    
+    def _close_bin(self):
+        self._pending.append((self._bin, self._sum/self._count if self._count else np.nan))
+        self._sum = 0.0
+        self._compensation = 0.0
+        self._count = 0
+    
+    #run the control law for every pending bin whose forecast window holds at least window bins
+    def _control(self, window):
+        ready = len(self._pending) - window + 1
+        if ready <= 0:
+            return []
+        pending = list(self._pending)
+        pv = np.empty(ready)
+        forecast = np.empty(ready)
+        for i in range(ready):
+            pv[i] = pending[i][1]
+            energy = 0.0
+            for _, pv_power in pending[i:i+self._forecast_periods]:
+                if pv_power == pv_power:
+                    energy += pv_power
+            forecast[i] = energy*self._conversion
+        outpower = np.empty(ready)
+        battpower = np.empty(ready)
+        battsoc = np.empty(ready)
+        violation_list = np.empty(ready, dtype=np.int64)
+        curtail = np.empty(ready)
+        self.previous_power, self.battery_soc, _ = self._kernel(pv, forecast, *self._args, outpower, battpower, battsoc, violation_list, curtail,
+                                                             self.previous_power, self.battery_soc)
+        emitted = []
+        for i in range(ready):
+            time = pd.Timestamp(self._origin + (pending[i][0]+1)*self._freq, tz=self._tz)
+            emitted.append(Setpoint(time, pv[i], outpower[i], battpower[i], battsoc[i], int(violation_list[i]), curtail[i]))
+            self._pending.popleft()
+        return emitted
     
+    @staticmethod
+    def _frame(emitted):
+        return pd.DataFrame(emitted, columns=Setpoint._fields).set_index('time')
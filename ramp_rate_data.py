@@ -0,0 +1,158 @@
+"""
+Copyright (c) 2021, Electric Power Research Institute
+ All rights reserved.
+ Redistribution and use in source and binary forms, with or without modification,
+ are permitted provided that the following conditions are met:
+     * Redistributions of source code must retain the above copyright notice,
+       this list of conditions and the following disclaimer.
+     * Redistributions in binary form must reproduce the above copyright notice,
+       this list of conditions and the following disclaimer in the documentation
+       and/or other materials provided with the distribution.
+     * Neither the name of DER-VET nor the names of its contributors
+       may be used to endorse or promote products derived from this software
+       without specific prior written permission.
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+ "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+ LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+ A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+ CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+ EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+ PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+ PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+ LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+ NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import os
+import json
+import numpy as np
+import pandas as pd
+from pandas.tseries.frequencies import to_offset
+import ramp_rate_control
+
+
+#a PV power record held as memory-mapped arrays - time (int64 nanoseconds since the epoch, UTC) and power (float64, divided by scale when read)
+#slices are turned into pandas series on demand, so the full record never has to fit in memory
+class PVRecord:
+    def __init__(self, time, power, tz=None, name=None, scale=1):
+        self.time = time
+        self.power = power
+        self.tz = tz
+        self.name = name
+        self.scale = scale
+    
+    def __len__(self):
+        return len(self.power)
+    
+    #samples start to stop as a time-indexed series (the values are copied out of the memory map)
+    def series(self, start=0, stop=None):
+        index = pd.DatetimeIndex(np.array(self.time[start:stop]).view('datetime64[ns]'))
+        if self.tz is not None:
+            index = index.tz_localize('UTC').tz_convert(self.tz)
+        return pd.Series(np.array(self.power[start:stop])/self.scale, index=index, name=self.name)
+    
+    #consecutive series of at most chunk_size samples
+    def chunks(self, chunk_size):
+        for start in range(0, len(self), chunk_size):
+            yield self.series(start, start + chunk_size)
+
+
+#load a PV power csv - the first call converts it to a binary cache (time.npy, power.npy) next to the file, later calls memory-map the cache
+#the timestamps are parsed from time_column (name or position). files without usable timestamps can instead give start and freq (e.g. '1/1/2019', 't'),
+#time_column is then ignored
+#timestamps with a UTC offset (e.g. a local time export that crosses daylight saving changes) are exact instants and are stored in UTC. tz is the zone the
+#series is returned in - without it they are returned in UTC, since a mix of offsets does not identify a zone. timestamps without an offset are wall time
+#in tz (naive if tz is None)
+#power_column selects the power column by name or position (default: the first numeric column other than the time column). power is divided by scale
+#the csv is read chunksize rows at a time, so converting does not need the whole file in memory. the cache is rebuilt when the csv changes
+def load_pv_data(csv_path, time_column=0, power_column=None, scale=1, start=None, freq=None, tz=None, cache_dir=None, chunksize=1000000):
+    cache_dir = cache_dir or csv_path + '.npycache'
+    source = os.stat(csv_path)
+    meta = {'source_size': source.st_size, 'source_mtime_ns': source.st_mtime_ns, 'time_column': time_column, 'power_column': power_column,
+            'start': None if start is None else str(start), 'freq': freq, 'zone': tz}
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    cached = None
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            cached = json.load(f)
+    if cached is None or any(cached.get(key) != value for key, value in meta.items()):
+        os.makedirs(cache_dir, exist_ok=True)
+        meta.update(_convert_csv(csv_path, cache_dir, time_column, power_column, start, freq, tz, chunksize))
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+        cached = meta
+    time = np.load(os.path.join(cache_dir, 'time.npy'), mmap_mode='r')
+    power = np.load(os.path.join(cache_dir, 'power.npy'), mmap_mode='r')
+    return PVRecord(time, power, cached['tz'], cached['name'], scale)
+
+def _convert_csv(csv_path, cache_dir, time_column, power_column, start, freq, tz, chunksize):
+    time_raw = os.path.join(cache_dir, 'time.bin')
+    power_raw = os.path.join(cache_dir, 'power.bin')
+    zone = None #zone of the parsed timestamps, used when tz is not given
+    offsets = None #whether the timestamps carry UTC offsets, decided from the first one
+    name = None
+    count = 0
+    last_time = None
+    with open(time_raw, 'wb') as time_file, open(power_raw, 'wb') as power_file:
+        for chunk in pd.read_csv(csv_path, chunksize=chunksize):
+            time_name = None if start is not None else chunk.columns[time_column] if isinstance(time_column, int) else time_column
+            if power_column is None:
+                column = chunk.drop(columns=[time_name] if time_name is not None else []).select_dtypes(include=[np.number]).columns[0]
+            else:
+                column = chunk.columns[power_column] if isinstance(power_column, int) else power_column
+            name = str(column)
+            if start is not None:
+                first = pd.Timestamp(start)
+                if first.tz is None and tz is not None:
+                    first = first.tz_localize(tz)
+                #only this chunk's timestamps, starting count steps after start
+                times = pd.date_range(start=first + count*to_offset(freq), periods=len(chunk), freq=freq)
+                zone = None if first.tz is None else str(first.tz)
+            else:
+                if offsets is None:
+                    offsets = pd.Timestamp(chunk[time_name].iloc[0]).tz is not None
+                if offsets:
+                    times = pd.DatetimeIndex(pd.to_datetime(chunk[time_name], utc=True))
+                    zone = 'UTC'
+                else:
+                    times = pd.DatetimeIndex(pd.to_datetime(chunk[time_name]))
+                    if tz is not None:
+                        times = times.tz_localize(tz, ambiguous='infer')
+            if times.tz is not None:
+                times = times.tz_convert('UTC').tz_localize(None)
+            time_values = times.values.astype('datetime64[ns]').view(np.int64)
+            if np.any(np.diff(time_values) <= 0) or (last_time is not None and len(time_values) and time_values[0] <= last_time):
+                raise ValueError('timestamps in %s must be strictly increasing' % csv_path)
+            if len(time_values):
+                last_time = time_values[-1]
+            time_file.write(np.ascontiguousarray(time_values).tobytes())
+            power_file.write(chunk[column].values.astype(np.float64).tobytes())
+            count += len(chunk)
+    
+    #turn the raw files into .npy files without loading them whole
+    for raw, dtype, final in [(time_raw, np.int64, 'time.npy'), (power_raw, np.float64, 'power.npy')]:
+        source = np.memmap(raw, dtype=dtype, mode='r', shape=(count,)) if count else np.empty(0, dtype=dtype)
+        target = np.lib.format.open_memmap(os.path.join(cache_dir, final), mode='w+', dtype=dtype, shape=(count,))
+        for position in range(0, count, chunksize):
+            target[position:position + chunksize] = source[position:position + chunksize]
+        target.flush()
+        del source, target
+        os.remove(raw)
+    return {'tz': tz if tz is not None else zone, 'name': name, 'length': count}
+
+
+#run the smoothing controller over a record chunk_size samples at a time, so peak memory depends on the chunk size rather than the record length
+#returns the violation count and the total energy, as run_smooth_controller does (the energy is summed chunk by chunk, so it can differ in the last digits)
+def run_chunked(record, settings, kp=1.2, ki=1.8, kf=0.3, soc_rest=0.5, chunk_size=1000000):
+    controller = ramp_rate_control.SmoothController(settings, kp, ki, kf, soc_rest)
+    violation_count = 0
+    total_energy = 0.0
+    for chunk in record.chunks(chunk_size):
+        setpoints = controller.update_chunk(chunk)
+        violation_count += int(setpoints['violation'].sum())
+        total_energy += setpoints['out_power'].sum()*settings['ramp_interval']/60
+    setpoints = controller.flush()
+    violation_count += sum(s.violation for s in setpoints)
+    total_energy += sum(s.out_power for s in setpoints)*settings['ramp_interval']/60
+    return violation_count, total_energy
@@ -0,0 +1,103 @@
+"""
+Copyright (c) 2021, Electric Power Research Institute
+ All rights reserved.
+ Redistribution and use in source and binary forms, with or without modification,
+ are permitted provided that the following conditions are met:
+     * Redistributions of source code must retain the above copyright notice,
+       this list of conditions and the following disclaimer.
+     * Redistributions in binary form must reproduce the above copyright notice,
+       this list of conditions and the following disclaimer in the documentation
+       and/or other materials provided with the distribution.
+     * Neither the name of DER-VET nor the names of its contributors
+       may be used to endorse or promote products derived from this software
+       without specific prior written permission.
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+ "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+ LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+ A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+ CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+ EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+ PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+ PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+ LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+ NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import os
+import csv
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+import ramp_rate_control
+import ramp_rate_data
+import ramp_rate_optimization
+
+
+#columns of the fleet output file, one row per site
+FLEET_COLUMNS = ['site', 'violations', 'energy', 'violations_train', 'violations_test', 'kp', 'ki', 'kf', 'soc_rest', 'error']
+
+
+#smooth (and optionally optimize) every site of a fleet, writing one row per site to output_path as soon as the site finishes
+#sites is a wide DataFrame with one power column per site, or a directory with one csv file per site (timestamps in the first column, named by the file stem)
+#site files are read with ramp_rate_data.load_pv_data, which keeps a binary cache next to each file. tz is the zone their timestamps are returned in
+#site_settings maps a site to a dict of settings overrides. nameplates maps a site to the AC nameplate rating its power is divided by (default 1 - already normalized)
+#with optimize the parameters of each site are found with ramp_rate_optimization.optimize_params (optimize_kwargs are passed through), otherwise params (kp, ki, kf, soc_rest) are used
+#sites already written to output_path without an error are skipped, so an interrupted run resumes where it stopped. sites that failed are run again and
+#their new row is appended after the old one. returns the output file as a DataFrame with the latest row of each site
+def run_fleet(sites, settings, output_path, site_settings=None, nameplates=None, workers=1, optimize=True, params=(1.2, 1.8, 0.3, 0.5), seed=None, tz=None, **optimize_kwargs):
+    site_settings = site_settings or {}
+    nameplates = nameplates or {}
+    if isinstance(sites, pd.DataFrame):
+        sources = {str(site): sites[site] for site in sites.columns}
+    else:
+        sources = {os.path.splitext(name)[0]: os.path.join(sites, name) for name in sorted(os.listdir(sites)) if name.lower().endswith('.csv')}
+    
+    completed = _completed_sites(output_path)
+    tasks = [(site, source, dict(settings, **site_settings.get(site, {})), nameplates.get(site, 1), optimize, params, seed, tz, optimize_kwargs)
+             for site, source in sources.items() if site not in completed]
+    
+    with open(output_path, 'a', newline='') as output:
+        writer = csv.DictWriter(output, fieldnames=FLEET_COLUMNS)
+        if output.tell() == 0:
+            writer.writeheader()
+        if ramp_rate_optimization._worker_count(workers) > 1 and len(tasks) > 1:
+            with ProcessPoolExecutor(min(ramp_rate_optimization._worker_count(workers), len(tasks))) as executor:
+                futures = [executor.submit(_run_site, *task) for task in tasks]
+                for future in as_completed(futures):
+                    _write_row(output, writer, future.result())
+        else:
+            for task in tasks:
+                _write_row(output, writer, _run_site(*task))
+    results = pd.read_csv(output_path, dtype={'site': str})
+    return results.drop_duplicates('site', keep='last').reset_index(drop=True)
+
+#sites already written without an error
+def _completed_sites(output_path):
+    if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
+        return set()
+    results = pd.read_csv(output_path, dtype={'site': str})
+    return set(results.loc[results['error'].isna(), 'site'])
+
+def _write_row(output, writer, row):
+    writer.writerow(row)
+    output.flush() #each finished site is on disk before the next one is waited for
+
+#read a site file - timestamps in the first column, power in the first numeric column after it
+def _load_site(path, tz=None):
+    return ramp_rate_data.load_pv_data(path, tz=tz).series()
+
+#runs in a worker process - errors are reported in the row rather than stopping the fleet
+def _run_site(site, source, settings, nameplate, optimize, params, seed, tz, optimize_kwargs):
+    row = {'site': site}
+    try:
+        data = _load_site(source, tz) if isinstance(source, str) else source
+        data = data.astype(np.float64)/nameplate
+        if optimize:
+            violations_train, violations_test, params = ramp_rate_optimization.optimize_params(data, settings, seed=seed, **optimize_kwargs)[:3]
+            row.update(violations_train=violations_train, violations_test=violations_test)
+        violations, energy = ramp_rate_control.run_smooth_controller(data, settings.copy(), 0, *params)
+        row.update(violations=violations, energy=energy, kp=params[0], ki=params[1], kf=params[2], soc_rest=params[3])
+    except Exception as e:
+        row['error'] = '%s: %s' % (type(e).__name__, e)
+    return row
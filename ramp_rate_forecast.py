@@ -0,0 +1,104 @@
+"""
+Copyright (c) 2021, Electric Power Research Institute
+ All rights reserved.
+ Redistribution and use in source and binary forms, with or without modification,
+ are permitted provided that the following conditions are met:
+     * Redistributions of source code must retain the above copyright notice,
+       this list of conditions and the following disclaimer.
+     * Redistributions in binary form must reproduce the above copyright notice,
+       this list of conditions and the following disclaimer in the documentation
+       and/or other materials provided with the distribution.
+     * Neither the name of DER-VET nor the names of its contributors
+       may be used to endorse or promote products derived from this software
+       without specific prior written permission.
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+ "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+ LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+ A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+ CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+ EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+ PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+ PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+ LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+ NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import numpy as np
+import pandas as pd
+import ramp_rate_control
+
+
+#forecast providers - each returns the forecast energy per ramp interval in the form the controller uses for its perfect forecast:
+#energy expected over the current and the next forecast_shift_periods-1 intervals, from a PV series already averaged over the ramp interval
+#missing intervals count as zero, as in the perfect forecast
+
+#the perfect forecast the controller uses by default
+def perfect_forecast(pv, forecast_shift_periods, ramp_interval):
+    return ramp_rate_control._forecast_energy(np.asarray(pv, dtype=np.float64), forecast_shift_periods, ramp_interval)
+
+#persistence - the power of the current interval is expected to continue over the whole window
+def persistence_forecast(pv, forecast_shift_periods, ramp_interval):
+    pv = np.nan_to_num(np.asarray(pv, dtype=np.float64))
+    return pv*forecast_shift_periods*(ramp_interval/60)
+
+#smart persistence - the clear sky index of the current interval is expected to continue, applied to the clear sky power of the window
+#clear_sky is the clear sky power on the same intervals. where it is below min_clear_sky (night, sunrise) the forecast falls back to persistence
+def smart_persistence_forecast(pv, clear_sky, forecast_shift_periods, ramp_interval, min_clear_sky=0.05):
+    pv = np.nan_to_num(np.asarray(pv, dtype=np.float64))
+    clear_sky = np.nan_to_num(np.asarray(clear_sky, dtype=np.float64))
+    clear_sky_energy = perfect_forecast(clear_sky, forecast_shift_periods, ramp_interval)
+    daylight = clear_sky >= min_clear_sky
+    clear_sky_index = np.where(daylight, pv/np.where(daylight, clear_sky, 1), 0)
+    return np.where(daylight, clear_sky_index*clear_sky_energy, persistence_forecast(pv, forecast_shift_periods, ramp_interval))
+
+#empirical clear sky power of a time-indexed PV series - the highest value at the same time of day within a window of days centred on each day
+def clear_sky_estimate(pv, days=15):
+    pv = pv.fillna(0)
+    day = pv.index.normalize()
+    table = pv.groupby([day, pv.index - day]).first().unstack()
+    table = table.rolling(days, center=True, min_periods=1).max()
+    clear_sky = table.stack()
+    clear_sky.index = clear_sky.index.get_level_values(0) + clear_sky.index.get_level_values(1)
+    return clear_sky.reindex(pv.index).fillna(0)
+
+
+#ensemble of forecasts as one (members x intervals) array - the forecast of the selected method plus a random error for each member
+#the error is drawn in units of power (times the nameplate) averaged over the forecast window: mean bias, standard deviation error_std
+#and lag one autocorrelation between consecutive intervals. forecasts are clipped at zero energy. seed fixes the draws
+#method is 'perfect', 'persistence' or 'smart_persistence' (clear_sky defaults to clear_sky_estimate of the resampled PV)
+#returns the PV series averaged over the ramp interval, which the rows are aligned with, and the ensemble
+def forecast_ensemble(pv_input, settings, method='perfect', members=100, error_std=0.05, bias=0.0, autocorrelation=0.0, clear_sky=None, seed=None):
+    PV_ramp_interval, _ = ramp_rate_control._preprocess(pv_input, settings)
+    shift = settings['forecast_shift_periods']
+    ramp_interval = settings['ramp_interval']
+    if method == 'perfect':
+        forecast = perfect_forecast(PV_ramp_interval.values, shift, ramp_interval)
+    elif method == 'persistence':
+        forecast = persistence_forecast(PV_ramp_interval.values, shift, ramp_interval)
+    elif method == 'smart_persistence':
+        if clear_sky is None:
+            clear_sky = clear_sky_estimate(PV_ramp_interval)
+        clear_sky = pd.Series(clear_sky, index=PV_ramp_interval.index) if not isinstance(clear_sky, pd.Series) else clear_sky.reindex(PV_ramp_interval.index)
+        forecast = smart_persistence_forecast(PV_ramp_interval.values, clear_sky.values, shift, ramp_interval)
+    else:
+        raise ValueError('unknown forecast method %r' % method)
+    
+    rng = np.random.RandomState(seed)
+    noise = rng.standard_normal((members, len(forecast)))
+    if autocorrelation:
+        #AR(1) filter along time for all members at once, scaled to keep unit variance
+        innovation = np.sqrt(1 - autocorrelation**2)
+        for i in range(1, noise.shape[1]):
+            noise[:, i] = autocorrelation*noise[:, i-1] + innovation*noise[:, i]
+    error = (bias + error_std*noise)*shift*(ramp_interval/60)
+    return PV_ramp_interval, np.clip(forecast + error, 0, None)
+
+
+#run the controller against every member of a forecast ensemble in one batched pass - returns an int64 array of violations and a float array of
+#total energy, one entry per member. the forecast term is always used here, whatever settings['short_forecast'] says
+#the remaining keyword arguments select the ensemble (see forecast_ensemble)
+def run_forecast_ensemble(pv_input, settings, kp=1.2, ki=1.8, kf=0.3, soc_rest=0.5, **ensemble_options):
+    settings = dict(settings, short_forecast=1)
+    _, ensemble = forecast_ensemble(pv_input, settings, **ensemble_options)
+    return ramp_rate_control.run_smooth_controller_batch(pv_input, settings, kp, ki, kf, soc_rest, forecast=ensemble)
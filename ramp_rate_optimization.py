@@ -24,6 +24,10 @@ Copyright (c) 2021, Electric Power Research Institute
  SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import numpy as np
 import pandas as pd
 import ramp_rate_control
@@ -31,37 +35,182 @@ import ramp_rate_control
 
 
 #sweeps battery sizes and finds # of violations for each. returns the violation count for the training set and the testing set seperately
-def size_sweep(data, settings, battery_sweep_range): 
+#workers > 1 optimizes the battery sizes in parallel processes (None uses every core). seed fixes the training/testing split so results do not depend on the worker count
+#progress is reported through ramp_rate_control.instrumentation - a 'size' event per battery size. the events of the optimization inside each size are only sent with workers=1
+#store is passed on to optimize_params, so sizes optimized before with the same data, settings and seed are not optimized again
+def size_sweep(data, settings, battery_sweep_range, workers=1, seed=None, store=None): 
     battery_size = []
     violations_train = []
     violations_test = []  
     energy_output = []
 
-    for battery_size_iter in battery_sweep_range:
-        print("Size %.2f" % battery_size_iter)
-        settings['battery_size'] = battery_size_iter
-        violations_iter_train, violations_iter_test, params = optimize_params(data, settings)
-        energy_output_iter = ramp_rate_control.run_smooth_controller(data.copy(), settings.copy(), 0, params[0], params[1], params[2], params[3])[1]
+    if _worker_count(workers) > 1:
+        shm, spec = _share_series(data)
+        try:
+            with ProcessPoolExecutor(_worker_count(workers), initializer=_init_worker, initargs=(spec, ramp_rate_control.instrumentation.enabled)) as executor:
+                results = list(executor.map(_size_sweep_task, battery_sweep_range, [settings.copy()]*len(battery_sweep_range), [seed]*len(battery_sweep_range),
+                                            [store]*len(battery_sweep_range)))
+            results = [_merge_worker_info(r) for r in results]
+        finally:
+            shm.close()
+            shm.unlink()
+    else:
+        results = [_size_sweep_point(data, settings, battery_size_iter, seed, store) for battery_size_iter in battery_sweep_range]
+
+    for battery_size_iter, (violations_iter_train, violations_iter_test, energy_output_iter) in zip(battery_sweep_range, results):
         violations_test.append(violations_iter_test)
         battery_size.append(battery_size_iter)
         violations_train.append(violations_iter_train)
         energy_output.append(energy_output_iter)
+        ramp_rate_control.instrumentation.event('size', battery_size=battery_size_iter, violations_train=violations_iter_train, violations_test=violations_iter_test, energy=energy_output_iter)
     return battery_size, violations_train, violations_test, energy_output
 
+#optimize a single battery size of the sweep - returns the training violations, testing violations and energy output
+def _size_sweep_point(data, settings, battery_size_iter, seed=None, store=None):
+    settings = dict(settings, battery_energy=battery_size_iter)
+    violations_iter_train, violations_iter_test, params = optimize_params(data, settings, seed=seed, store=store)
+    energy_output_iter = ramp_rate_control.run_smooth_controller(data.copy(), settings.copy(), 0, params[0], params[1], params[2], params[3])[1]
+    return violations_iter_train, violations_iter_test, energy_output_iter
+
+#find the smallest battery energy whose optimized controller meets target_violations (violations over the whole record) - bisection between
+#energy_range, which relies on the violations not increasing with battery energy. the search stops once the bracket is narrower than tolerance
+#with power_range, the smallest battery power that meets the target at that energy is then searched the same way (otherwise settings['battery_power'] is used)
+#every size is optimized with optimize_params, starting from the best parameters of the size evaluated before it. optimizer and the other keyword arguments
+#are passed on - the default pattern search is the one that makes use of the warm start. pass a dict as cache to reuse optimized sizes across calls,
+#entries are keyed by the data, settings, seed, optimizer options and warm start point so a shared cache never returns results for other inputs
+#returns the battery energy, the battery power, the optimized parameters at that size and a DataFrame of every size evaluated
+def min_battery_size(data, settings, target_violations, energy_range=(0, 1), power_range=None, tolerance=0.01, seed=None, optimizer='pattern', cache=None, **optimize_kwargs):
+    if cache is None:
+        cache = {}
+    base_key = (ramp_rate_control.fingerprint(data), tuple(sorted((k, v) for k, v in settings.items() if k not in ('battery_energy', 'battery_power'))),
+                seed, optimizer, tuple(sorted((k, v) for k, v in optimize_kwargs.items() if k != 'store')))
+    evaluated = []
+    def meets(battery_energy, battery_power):
+        x0 = evaluated[-1]['params'] if evaluated else None
+        key = base_key + (round(battery_energy, 9), round(battery_power, 9), None if x0 is None else tuple(np.round(x0, 9).tolist()))
+        if key not in cache:
+            cache[key] = _optimize_size(data, settings, battery_energy, battery_power, seed, optimizer, x0, optimize_kwargs)
+        evaluated.append(cache[key])
+        ramp_rate_control.instrumentation.event('size', battery_energy=battery_energy, battery_power=battery_power, violations=cache[key]['violations'])
+        return cache[key]['violations'] <= target_violations
+    
+    #smallest value between low and high that meets the target, given a function of that value
+    def bisect(low, high, meets_at):
+        if not meets_at(high):
+            raise ValueError('the largest battery in the range does not meet the violation target')
+        if meets_at(low):
+            return low
+        while high - low > tolerance:
+            middle = (low + high)/2
+            if meets_at(middle):
+                high = middle
+            else:
+                low = middle
+        return high
+    
+    battery_power = settings['battery_power'] if power_range is None else power_range[1]
+    battery_energy = bisect(energy_range[0], energy_range[1], lambda energy: meets(energy, battery_power))
+    if power_range is not None:
+        battery_power = bisect(power_range[0], power_range[1], lambda power: meets(battery_energy, power))
+    result = [row for row in evaluated if row['battery_energy'] == battery_energy and row['battery_power'] == battery_power][-1]
+    table = pd.DataFrame(evaluated).drop(columns='params').drop_duplicates(['battery_energy', 'battery_power']).sort_values(['battery_energy', 'battery_power'])
+    return battery_energy, battery_power, result['params'], table.reset_index(drop=True)
+
+#optimize one battery size and score the optimized parameters over the whole record
+def _optimize_size(data, settings, battery_energy, battery_power, seed, optimizer, x0, optimize_kwargs):
+    settings = dict(settings, battery_energy=battery_energy, battery_power=battery_power)
+    violations_train, violations_test, params = optimize_params(data, settings, seed=seed, optimizer=optimizer, x0=x0, **optimize_kwargs)[:3]
+    violations, energy = ramp_rate_control.run_smooth_controller(data, settings.copy(), 0, *params)
+    return {'battery_energy': battery_energy, 'battery_power': battery_power, 'violations': violations, 'violations_train': violations_train,
+            'violations_test': violations_test, 'energy': energy, 'kp': params[0], 'ki': params[1], 'kf': params[2], 'soc_rest': params[3], 'params': params}
+
 #for a given battery size and control settting - find the optimal parameters - return the parameters as well as the number of violations in the training and testing sets
-def optimize_params(data, settings):
+#workers > 1 scores the grid points of each search level in parallel processes (None uses every core). seed fixes the training/testing split
+#daily_split scores each grid point with a single run over the full data and totals the violations of the training and testing days from the per-day results,
+#instead of running once on each zero filled set. this halves the simulation cost but is not exactly equivalent: the battery state and previous output at the
+#start of each day come from the real previous day rather than from a zero filled one, and an interval is counted on the day it starts in
+#optimizer selects the search: 'grid' (the level by level grid search), 'pattern', 'nelder-mead', or a function with the same interface as pattern_search.
+#the derivative-free optimizers search kf as well when short_forecast is on, starting from x0 (kp, ki, kf, soc_rest - default is the middle of the ranges).
+#evaluations are memoized by parameter values rounded to 6 decimals. max_evaluations and max_time (seconds) bound the search, which then returns the best point found.
+#with return_trace the convergence trace is returned as a fourth value - a list of (evaluations, best training violations scaled like train_min, elapsed seconds)
+#prune lets the derivative-free optimizers stop a training run as soon as it can no longer beat the point it is compared with (see ramp_rate_control.prune_stats).
+#the grid search compares level averages, which need every count, so it never prunes. daily_split runs cannot be pruned either, since the cutoff applies to the training days only
+#progress is reported through ramp_rate_control.instrumentation - a 'level' event per grid search level, a 'search' event per batch of derivative-free
+#evaluations and an 'optimum' event with the result. with workers > 1 the timers and counters of the worker processes are added to it as well
+#store (a ramp_rate_store.ResultStore) keeps every evaluation and the result on disk, keyed by the data, settings, seed and search options, for reuse by
+#later calls in any process. it needs a seed, since without one the training/testing split is not reproducible. results of searches bounded by
+#max_time or run by a custom optimizer function are not stored, but their evaluations are
+def optimize_params(data, settings, workers=1, seed=None, daily_split=False, optimizer='grid', x0=None, max_evaluations=None, max_time=None, return_trace=False, prune=True, store=None):
+    if store is None or seed is None:
+        return _optimize_params(data, settings, workers, seed, daily_split, optimizer, x0, max_evaluations, max_time, return_trace, prune)
+    data_key = (ramp_rate_control.fingerprint(data), settings, seed, daily_split)
+    if not isinstance(optimizer, str) or max_time is not None:
+        return _optimize_params(data, settings, workers, seed, daily_split, optimizer, x0, max_evaluations, max_time, return_trace, prune, (store, data_key))
+    result_key = store.key('optimize_params', *data_key, optimizer, x0, max_evaluations, return_trace)
+    result = store.get(result_key)
+    if result is None:
+        result = _optimize_params(data, settings, workers, seed, daily_split, optimizer, x0, max_evaluations, max_time, return_trace, prune, (store, data_key))
+        store.put(result_key, result)
+    else:
+        ramp_rate_control.instrumentation.event('optimum', violations_train=result[0], violations_test=result[1], params=result[2], evaluations=0)
+    return result
+
+#optimize_params without the result store - evaluation_store is an optional (store, key) pair the evaluations are kept under
+def _optimize_params(data, settings, workers, seed, daily_split, optimizer, x0, max_evaluations, max_time, return_trace, prune, evaluation_store=None):
     #split the data into random, equal sized testing and training sets
-    date_number_index = []
-    for date_count in list(range(1,366)):
-        date_number_index = np.append(date_number_index, date_count*np.ones(1440))
-    date_number = pd.Series(date_number_index, data.index)
-    training_days = np.random.choice(365, size=182, replace=False)
-    training_set = data[date_number.isin(training_days)]
-    testing_set = data[~date_number.isin(training_days)]
-    training_set = training_set.reindex(index = data.index, fill_value=0)
-    testing_set = testing_set.reindex(index = data.index, fill_value=0)     
-    #optimize over four parameters
-    cols = ['Vio','kp','ki','kf','soc_rest']
+    n_days = _day_numbers(data.index, data.index)[-1]
+    if seed is None:
+        training_days = np.random.choice(n_days, size=n_days//2, replace=False)
+    else:
+        training_days = np.random.RandomState(seed).choice(n_days, size=n_days//2, replace=False)
+    
+    if _worker_count(workers) > 1:
+        shm, spec = _share_series(data)
+        try:
+            with ProcessPoolExecutor(_worker_count(workers), initializer=_init_worker,
+                                     initargs=(spec, ramp_rate_control.instrumentation.enabled, training_days, settings, daily_split)) as executor:
+                def score_grid(grid, cutoff=None):
+                    chunks = np.array_split(grid, min(_worker_count(workers), len(grid)))
+                    results = [_merge_worker_info(r) for r in executor.map(_score_grid_task, chunks, [cutoff]*len(chunks))]
+                    for r in results: #pruning happens in the workers
+                        ramp_rate_control.prune_stats.add(*r[2])
+                    return np.concatenate([r[0] for r in results]), np.concatenate([r[1] for r in results])
+                return _search(score_grid, settings, optimizer, x0, max_evaluations, max_time, return_trace, prune, evaluation_store)
+        finally:
+            shm.close()
+            shm.unlink()
+    
+    return _search(_grid_scorer(data, training_days, settings, daily_split), settings, optimizer, x0, max_evaluations, max_time, return_trace, prune, evaluation_store)
+
+#run the selected optimizer on top of the memoized evaluations
+def _search(score_grid, settings, optimizer, x0, max_evaluations, max_time, return_trace, prune=True, evaluation_store=None):
+    evaluations = _Evaluations(score_grid, max_evaluations, max_time, store=evaluation_store)
+    try:
+        if optimizer == 'grid':
+            result = _grid_search(evaluations, settings)
+        else:
+            bounds = _parameter_bounds(settings)
+            if not settings['short_forecast']: #kf has no effect without the forecast
+                bounds[2] = 0
+            if x0 is None:
+                x0 = bounds.mean(axis=1)
+            instrumentation = ramp_rate_control.instrumentation
+            def evaluate(points, cutoff=None):
+                violations = evaluations(points, cutoff if prune else None)[0]
+                if instrumentation.enabled and evaluations.trace:
+                    instrumentation.event('search', evaluations=evaluations.count, best=evaluations.trace[-1][1], elapsed=evaluations.trace[-1][2])
+                return violations
+            OPTIMIZERS.get(optimizer, optimizer)(evaluate, bounds, np.array(x0, dtype=np.float64))
+            result = evaluations.best_result()
+    except _BudgetExhausted:
+        result = evaluations.best_result()
+    ramp_rate_control.instrumentation.event('optimum', violations_train=result[0], violations_test=result[1], params=result[2], evaluations=evaluations.count)
+    if return_trace:
+        return result + (evaluations.trace,)
+    return result
+
+#search ranges of kp, ki, kf and soc_rest - one (low, high) row per parameter
+def _parameter_bounds(settings):
     kp_range = [0, 2]
     ki_range = [0, 2]
     #scale ki range by ramp interval - default range is for is 10 minutes
@@ -70,6 +219,224 @@ def optimize_params(data, settings):
     soc_rest_range = [0.3, 0.7]
     if settings['curtail_as_control']:
         soc_rest_range = [0.99, 1]
+    return np.array([kp_range, ki_range, kf_range, soc_rest_range], dtype=np.float64)
+
+class _BudgetExhausted(Exception):
+    pass
+
+#wraps a grid scoring function: results are memoized by rounded parameter values, new evaluations are counted against the budget
+#and the best training result is tracked for the convergence trace. a run pruned by a cutoff is remembered as exceeding that cutoff
+#store is an optional (ResultStore, key) pair - results found there count against the budget like new evaluations, so the search does not change,
+#but are not simulated again. completed runs are added to it
+class _Evaluations:
+    def __init__(self, score_grid, max_evaluations=None, max_time=None, decimals=6, store=None):
+        self.score_grid = score_grid
+        self.store = store
+        self.max_evaluations = max_evaluations
+        self.max_time = max_time
+        self.decimals = decimals
+        self.cache = {}
+        self.exceeded = {} #rounded parameters -> largest cutoff the training violations are known to exceed
+        self.count = 0
+        self.best = None #(training violations, testing violations, parameters)
+        self.trace = []
+        self.start = time.time()
+    
+    #same interface as score_grid - raises _BudgetExhausted once the budget is used up
+    #with a cutoff, points whose training violations exceed it are returned as inf with a NaN testing count
+    def __call__(self, grid, cutoff=None):
+        grid = np.atleast_2d(np.asarray(grid, dtype=np.float64))
+        keys = [tuple(np.round(row, self.decimals).tolist()) for row in grid]
+        new = {}
+        for key, row in zip(keys, grid):
+            known_exceeded = cutoff is not None and self.exceeded.get(key, -1) >= cutoff
+            if key not in self.cache and not known_exceeded and key not in new:
+                new[key] = row
+        exhausted = False
+        if new:
+            remaining = None if self.max_evaluations is None else self.max_evaluations - self.count
+            if (remaining is not None and remaining <= 0) or (self.max_time is not None and time.time() - self.start > self.max_time):
+                raise _BudgetExhausted()
+            if remaining is not None and len(new) > remaining:
+                new = dict(list(new.items())[:remaining])
+                exhausted = True
+            rows = np.array(list(new.values()))
+            violations_train, violations_test = self._score(list(new), rows, cutoff)
+            for key, row, violation_train, violation_test in zip(new, rows, violations_train, violations_test):
+                if violation_train == np.inf:
+                    self.exceeded[key] = max(self.exceeded.get(key, -1), cutoff)
+                    continue
+                self.cache[key] = (int(violation_train), int(violation_test))
+                if self.best is None or violation_train < self.best[0]:
+                    self.best = self.cache[key] + (list(row),)
+            self.count += len(rows)
+            if self.best is not None:
+                self.trace.append((self.count, self.best[0]*2, time.time() - self.start))
+        if exhausted:
+            raise _BudgetExhausted()
+        results = [self.cache.get(key, (np.inf, np.nan)) for key in keys]
+        return np.array([r[0] for r in results]), np.array([r[1] for r in results])
+    
+    #score rows through the store when there is one - only the rows it does not answer are simulated
+    #the store holds (training, testing) violations of completed runs, or (None, c) for a run known to exceed the cutoff c
+    def _score(self, keys, rows, cutoff):
+        if self.store is None:
+            return self.score_grid(rows) if cutoff is None else self.score_grid(rows, cutoff)
+        store, prefix = self.store
+        store_keys = [store.key('evaluation', *prefix, key) for key in keys]
+        stored = [store.get(store_key) for store_key in store_keys]
+        violations_train = np.full(len(rows), np.nan)
+        violations_test = np.full(len(rows), np.nan)
+        missing = []
+        for i, value in enumerate(stored):
+            if value is not None and value[0] is not None:
+                violations_train[i], violations_test[i] = value
+            elif value is not None and cutoff is not None and value[1] >= cutoff:
+                violations_train[i] = np.inf
+            else:
+                missing.append(i)
+        if missing:
+            scored = self.score_grid(rows[missing]) if cutoff is None else self.score_grid(rows[missing], cutoff)
+            violations_train[missing], violations_test[missing] = scored
+            for i in missing:
+                if violations_train[i] != np.inf:
+                    store.put(store_keys[i], (int(violations_train[i]), int(violations_test[i])))
+                elif stored[i] is None or stored[i][1] < cutoff:
+                    store.put(store_keys[i], (None, cutoff))
+        return violations_train, violations_test
+    
+    #result of the best point evaluated so far, in the form returned by optimize_params
+    def best_result(self):
+        if self.best is None:
+            raise ValueError('no parameters were evaluated within the budget')
+        violation_train, violation_test, params = self.best
+        return violation_train*2, violation_test*2, params
+
+#derivative-free optimizers - each takes evaluate (maps an array of (kp, ki, kf, soc_rest) rows to training violations), bounds (one (low, high) row
+#per parameter, equal values fix a parameter) and x0. they return the best point and stop early when evaluate raises on an exhausted budget
+#evaluate(points, cutoff) may report points with more than cutoff violations as inf without finishing their runs
+
+#coordinate pattern search - polls a step up and down along every free parameter, moves to the best improving poll, and halves the steps when none improves
+def pattern_search(evaluate, bounds, x0, tolerance=1e-3):
+    lower, upper = bounds[:,0], bounds[:,1]
+    span = upper - lower
+    free = np.flatnonzero(span > 0)
+    x = np.clip(x0, lower, upper)
+    fx = evaluate(x[None])[0]
+    step = span/4
+    while np.any(step[free] > tolerance*span[free]):
+        polls = []
+        for d in free:
+            for sign in (1, -1):
+                poll = x.copy()
+                poll[d] = np.clip(x[d] + sign*step[d], lower[d], upper[d])
+                if poll[d] != x[d]:
+                    polls.append(poll)
+        values = evaluate(np.array(polls), fx)
+        best = np.argmin(values)
+        if values[best] < fx:
+            x, fx = polls[best], values[best]
+        else:
+            step = step/2
+    return x
+
+#Nelder-Mead simplex search over the free parameters, points are clipped to the bounds
+def nelder_mead(evaluate, bounds, x0, tolerance=1e-3, initial_step=0.25):
+    lower, upper = bounds[:,0], bounds[:,1]
+    span = upper - lower
+    free = np.flatnonzero(span > 0)
+    def point(z):
+        x = np.clip(x0, lower, upper)
+        x[free] = np.clip(z, lower[free], upper[free])
+        return x
+    def f(z, cutoff=None):
+        return evaluate(point(z)[None], cutoff)[0]
+    start = point(np.clip(x0, lower, upper)[free])[free]
+    simplex = [start]
+    for i, d in enumerate(free):
+        vertex = start.copy()
+        vertex[i] = vertex[i] + initial_step*span[d] if vertex[i] + initial_step*span[d] <= upper[d] else vertex[i] - initial_step*span[d]
+        simplex.append(vertex)
+    simplex = np.array(simplex)
+    values = evaluate(np.array([point(z) for z in simplex]))
+    while np.max(np.abs(simplex - simplex[0])/span[free]) > tolerance:
+        order = np.argsort(values, kind='stable')
+        simplex, values = simplex[order], values[order]
+        centroid = simplex[:-1].mean(axis=0)
+        reflected = np.clip(centroid + (centroid - simplex[-1]), lower[free], upper[free])
+        f_reflected = f(reflected, values[-2]) #only used if it beats the second worst vertex
+        if f_reflected < values[0]:
+            expanded = np.clip(centroid + 2*(centroid - simplex[-1]), lower[free], upper[free])
+            f_expanded = f(expanded, f_reflected)
+            if f_expanded < f_reflected:
+                simplex[-1], values[-1] = expanded, f_expanded
+            else:
+                simplex[-1], values[-1] = reflected, f_reflected
+        elif f_reflected < values[-2]:
+            simplex[-1], values[-1] = reflected, f_reflected
+        else:
+            contracted = centroid + 0.5*(simplex[-1] - centroid)
+            f_contracted = f(contracted, values[-1])
+            if f_contracted < values[-1]:
+                simplex[-1], values[-1] = contracted, f_contracted
+            else: #shrink towards the best vertex
+                simplex[1:] = simplex[0] + 0.5*(simplex[1:] - simplex[0])
+                values[1:] = evaluate(np.array([point(z) for z in simplex[1:]]))
+    return point(simplex[np.argmin(values)])
+
+OPTIMIZERS = {'pattern': pattern_search, 'nelder-mead': nelder_mead}
+
+#number the calendar days of index from 1, counting from the first day of data_index
+def _day_numbers(index, data_index):
+    #count calendar days on local wall time, so a 23 or 25 hour day at a daylight saving change is still one day
+    if index.tz is not None:
+        index = index.tz_localize(None)
+    if data_index.tz is not None:
+        data_index = data_index.tz_localize(None)
+    return np.asarray((index.normalize() - data_index[0].normalize()).days) + 1
+
+#build the function that scores an array of (kp, ki, kf, soc_rest) rows - it returns the violation counts on the training days and on the testing days
+#with a cutoff, training runs stop once they exceed it - they are reported as inf and their testing runs are skipped (NaN)
+def _grid_scorer(data, training_days, settings, daily_split):
+    if daily_split:
+        def score_grid(grid, cutoff=None): #the cutoff cannot be applied to the training days of a single run
+            days, daily_violations, _ = ramp_rate_control.run_smooth_controller_daily(data, settings.copy(), grid[:,0], grid[:,1], grid[:,2], grid[:,3])
+            training = np.isin(_day_numbers(days, data.index), training_days)
+            return daily_violations[:, training].sum(axis=1), daily_violations[:, ~training].sum(axis=1)
+    else:
+        training_set, testing_set = _split_sets(data, training_days)
+        def score_grid(grid, cutoff=None):
+            return _score_grid(training_set, testing_set, settings, grid, cutoff)
+    return score_grid
+
+#zero fill the days that are not part of each set - returns the training set and testing set over the full data index
+def _split_sets(data, training_days):
+    date_number = pd.Series(_day_numbers(data.index, data.index), data.index)
+    training_set = data[date_number.isin(training_days)]
+    testing_set = data[~date_number.isin(training_days)]
+    training_set = training_set.reindex(index = data.index, fill_value=0)
+    testing_set = testing_set.reindex(index = data.index, fill_value=0)     
+    return training_set, testing_set
+
+#score each row of grid (kp, ki, kf, soc_rest) - returns the violation counts on the training set and on the testing set
+def _score_grid(training_set, testing_set, settings, grid, cutoff=None):
+    violations_train = ramp_rate_control.run_smooth_controller_batch(training_set, settings.copy(), grid[:,0], grid[:,1], grid[:,2], grid[:,3], cutoff)[0]
+    if cutoff is None:
+        violations_test = ramp_rate_control.run_smooth_controller_batch(testing_set, settings.copy(), grid[:,0], grid[:,1], grid[:,2], grid[:,3])[0]
+        return violations_train, violations_test
+    exceeded = violations_train > cutoff
+    violations_train = np.where(exceeded, np.inf, violations_train)
+    violations_test = np.full(len(grid), np.nan)
+    if not exceeded.all():
+        remaining = grid[~exceeded]
+        violations_test[~exceeded] = ramp_rate_control.run_smooth_controller_batch(testing_set, settings.copy(), remaining[:,0], remaining[:,1], remaining[:,2], remaining[:,3])[0]
+    return violations_train, violations_test
+
+#search the parameter space level by level - score_grid maps an array of (kp, ki, kf, soc_rest) rows to training and testing violation counts
+def _grid_search(score_grid, settings):
+    #optimize over four parameters
+    cols = ['Vio','kp','ki','kf','soc_rest']
+    kp_range, ki_range, kf_range, soc_rest_range = _parameter_bounds(settings)
 
     
     sections = 2 #2 is most efficient (binomial search)
@@ -84,25 +451,30 @@ def optimize_params(data, settings):
     #of iterations equals sections^[(# of parameters)*(number of iterations)]
     for level in list(range(max_iterations)):
         if continue_flag2:
-            print('Search level %.0f' % level)
             violations_iter = []
             violations_iter_test = []
             kp_step = (kp_range[1]-kp_range[0])/sections
             ki_step = (ki_range[1]-ki_range[0])/sections
             kf_step = (kf_range[1]-kf_range[0])/sections
             soc_rest_step = (soc_rest_range[1]-soc_rest_range[0])/sections
+            grid = []
             for soc_rest_value in np.arange(soc_rest_range[0], soc_rest_range[0]+soc_rest_step*sections, soc_rest_step) + soc_rest_step/2:
                 kf_value = 0#for kf_value in np.arange(kf_range[0], kf_range[0]+kf_step*sections, kf_step) + kf_step/2:
                 if 1:
                     for ki_value in np.arange(ki_range[0], ki_range[0]+ki_step*sections, ki_step) + ki_step/2:
                         for kp_value in np.arange(kp_range[0], kp_range[0]+kp_step*sections, kp_step) + kp_step/2:
-                            #train
-                            violation_temp = ramp_rate_control.run_smooth_controller(training_set, settings.copy(), 0, kp=kp_value, ki=ki_value, kf=kf_value, soc_rest=soc_rest_value)[0]
-                            print("Optimization Run: Violations: " + str(violation_temp))
-                            violations_iter.append([violation_temp, kp_value, ki_value, kf_value, soc_rest_value])
-                            violation_temp_test = ramp_rate_control.run_smooth_controller(testing_set, settings, 0, kp=kp_value, ki=ki_value, kf=kf_value, soc_rest=soc_rest_value)[0]
-                            violations_iter_test.append(violation_temp_test)
+                            grid.append([kp_value, ki_value, kf_value, soc_rest_value])
+            #score the whole level in one pass over each data set
+            grid = np.array(grid)
+            violations_train, violations_test = score_grid(grid)
+            for [kp_value, ki_value, kf_value, soc_rest_value], violation_temp, violation_temp_test in zip(grid, violations_train, violations_test):
+                violations_iter.append([violation_temp, kp_value, ki_value, kf_value, soc_rest_value])
+                violations_iter_test.append(violation_temp_test)
             result_df = pd.DataFrame(violations_iter, columns=cols)
+            instrumentation = ramp_rate_control.instrumentation
+            if instrumentation.enabled:
+                instrumentation.event('level', level=level, runs=len(grid), best=result_df['Vio'].min()*2, average=result_df['Vio'].mean()*2,
+                                      runs_per_second=instrumentation.info()['runs_per_second'])
             if result_df['Vio'].mean() < violation_ave: #if this level is better than the previous one
 #                Method 1: pick the best row - found to yield a slightly less optimum value on average than method 2 (more testing needed)
                 if method == 1:
@@ -160,11 +532,71 @@ def optimize_params(data, settings):
 #                    print('Optimization iteration level worse than previous')
 #                    print('Optimal Parameters')
 #                    print("level %.0f" % level)
-                    print([kp_best, ki_best, kf_best, soc_rest_best, np.min(violations_iter_test)*2])
+#                    print([kp_best, ki_best, kf_best, soc_rest_best, np.min(violations_iter_test)*2])
 
     test_min = np.min(violations_iter_test)*2
     train_min = best_row['Vio'].values[0]*2
     
     return train_min, test_min, [kp_best, ki_best, kf_best, soc_rest_best]
 
-    
+
+#parallel execution helpers
+#the pv series is copied once into shared memory - worker processes rebuild it from there instead of receiving a pickled copy with every task
+_worker_state = {}
+
+def _worker_count(workers):
+    if workers is None:
+        return os.cpu_count()
+    return max(int(workers), 1)
+
+#copy a time-indexed series into a new shared memory block - returns the block and the spec needed to attach to it
+def _share_series(series):
+    values = np.ascontiguousarray(series.values, dtype=np.float64)
+    index = series.index.asi8
+    shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes + index.nbytes, 1))
+    np.ndarray(values.shape, dtype=np.float64, buffer=shm.buf)[:] = values
+    np.ndarray(index.shape, dtype=np.int64, buffer=shm.buf, offset=values.nbytes)[:] = index
+    return shm, (shm.name, len(values), series.index.tz, series.name)
+
+def _attach_series(spec):
+    name, length, tz, series_name = spec
+    shm = shared_memory.SharedMemory(name=name)
+    values = np.ndarray((length,), dtype=np.float64, buffer=shm.buf)
+    index = pd.DatetimeIndex(np.ndarray((length,), dtype=np.int64, buffer=shm.buf, offset=length*8).view('datetime64[ns]'))
+    if tz is not None:
+        index = index.tz_localize('UTC').tz_convert(tz)
+    return shm, pd.Series(values, index=index, name=series_name, copy=False)
+
+#runs once in every worker process - instrumented enables the timers and counters, which each task then returns to the parent
+def _init_worker(spec, instrumented=False, training_days=None, settings=None, daily_split=False):
+    if instrumented:
+        ramp_rate_control.instrumentation.enable()
+    shm, data = _attach_series(spec)
+    _worker_state['shm'] = shm #keep the block mapped for the lifetime of the worker
+    _worker_state['data'] = data
+    if training_days is not None:
+        _worker_state['score_grid'] = _grid_scorer(data, training_days, settings, daily_split)
+
+def _score_grid_task(grid, cutoff=None):
+    stats = ramp_rate_control.prune_stats
+    before = (stats.runs, stats.pruned, stats.intervals_saved)
+    ramp_rate_control.instrumentation.clear()
+    violations_train, violations_test = _worker_state['score_grid'](grid, cutoff)
+    return (violations_train, violations_test, (stats.runs - before[0], stats.pruned - before[1], stats.intervals_saved - before[2]),
+            _worker_info())
+
+def _size_sweep_task(battery_size_iter, settings, seed, store=None):
+    ramp_rate_control.instrumentation.clear()
+    return _size_sweep_point(_worker_state['data'], settings, battery_size_iter, seed, store) + (_worker_info(),)
+
+#timers and counters of the task that just ran in this worker, None when not instrumented
+def _worker_info():
+    if ramp_rate_control.instrumentation.enabled:
+        return ramp_rate_control.instrumentation.info()
+    return None
+
+#add the timers and counters returned by a worker task to this process and strip them from the result
+def _merge_worker_info(result):
+    if result[-1] is not None:
+        ramp_rate_control.instrumentation.merge(result[-1])
+    return result[:-1]
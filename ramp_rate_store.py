@@ -0,0 +1,136 @@
+"""
+Copyright (c) 2021, Electric Power Research Institute
+ All rights reserved.
+ Redistribution and use in source and binary forms, with or without modification,
+ are permitted provided that the following conditions are met:
+     * Redistributions of source code must retain the above copyright notice,
+       this list of conditions and the following disclaimer.
+     * Redistributions in binary form must reproduce the above copyright notice,
+       this list of conditions and the following disclaimer in the documentation
+       and/or other materials provided with the distribution.
+     * Neither the name of DER-VET nor the names of its contributors
+       may be used to endorse or promote products derived from this software
+       without specific prior written permission.
+ THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+ "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+ LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+ A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR
+ CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+ EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+ PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+ PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+ LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+ NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import hashlib
+import inspect
+import pickle
+import sqlite3
+import time
+import numpy as np
+import ramp_rate_control
+import ramp_rate_optimization
+
+
+#hash of the source of the controller and optimization modules - any change to either invalidates every stored result
+def code_version():
+    digest = hashlib.blake2b(digest_size=16)
+    for module in (ramp_rate_control, ramp_rate_optimization):
+        digest.update(inspect.getsource(module).encode())
+    return digest.hexdigest()
+
+#turn a key part into a canonical, hashable form - dicts are sorted, arrays and numpy scalars become python values
+def _canonical(part):
+    if isinstance(part, dict):
+        return tuple(sorted((k, _canonical(v)) for k, v in part.items()))
+    if isinstance(part, (list, tuple, np.ndarray)):
+        return tuple(_canonical(v) for v in part)
+    if isinstance(part, np.generic):
+        return part.item()
+    return part
+
+
+#persistent store of results in a sqlite file, shared by processes and sessions
+#values are pickled and looked up by a hash of the key parts. results written by another version of the code (see code_version) are deleted when
+#the store is opened, and once the stored values exceed max_bytes the least recently used are evicted. hits and misses are counted
+#the store pickles as its path and options, so it can be passed to worker processes, which open their own connection
+#the size of the stored values is tracked as a running total, resynchronized with the file (which other processes may also write to)
+#every RESYNC_PUTS writes and before evicting. eviction frees down to EVICT_TO of max_bytes, so the following writes do not evict again
+class ResultStore:
+    RESYNC_PUTS = 1000
+    EVICT_TO = 0.9
+    
+    def __init__(self, path, max_bytes=256*2**20):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.version = code_version()
+        self.hits = 0
+        self.misses = 0
+        self._connection = sqlite3.connect(path, timeout=60)
+        with self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, version TEXT, value BLOB, size INTEGER, used REAL)')
+            self._connection.execute('DELETE FROM results WHERE version != ?', (self.version,))
+        self._puts = 0
+        self._total = self._stored_bytes()
+    
+    def __getstate__(self):
+        return {'path': self.path, 'max_bytes': self.max_bytes}
+    
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['max_bytes'])
+    
+    @staticmethod
+    def key(*parts):
+        return hashlib.blake2b(repr(_canonical(parts)).encode(), digest_size=20).hexdigest()
+    
+    #stored value of key, or None
+    def get(self, key):
+        row = self._connection.execute('SELECT value FROM results WHERE key = ? AND version = ?', (key, self.version)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        with self._connection:
+            self._connection.execute('UPDATE results SET used = ? WHERE key = ?', (time.time(), key))
+        return pickle.loads(row[0])
+    
+    def put(self, key, value):
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._connection:
+            replaced = self._connection.execute('SELECT size FROM results WHERE key = ?', (key,)).fetchone()
+            self._connection.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)', (key, self.version, blob, len(blob), time.time()))
+            self._total += len(blob) - (replaced[0] if replaced else 0)
+            self._puts += 1
+            if self._total > self.max_bytes or self._puts % self.RESYNC_PUTS == 0:
+                self._total = self._stored_bytes()
+            if self._total > self.max_bytes:
+                self._evict()
+    
+    def _stored_bytes(self):
+        return self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+    
+    #delete least recently used results until the stored values fit in EVICT_TO of max_bytes
+    def _evict(self):
+        evicted = []
+        for key, size in self._connection.execute('SELECT key, size FROM results ORDER BY used'):
+            if self._total <= self.max_bytes*self.EVICT_TO:
+                break
+            evicted.append((key,))
+            self._total -= size
+        self._connection.executemany('DELETE FROM results WHERE key = ?', evicted)
+    
+    def clear(self):
+        with self._connection:
+            self._connection.execute('DELETE FROM results')
+        self._total = 0
+        self.hits = 0
+        self.misses = 0
+    
+    def info(self):
+        count, size = self._connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results').fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'entries': count, 'bytes': size, 'max_bytes': self.max_bytes, 'version': self.version}
+    
+    def close(self):
+        self._connection.close()